@@ -1,21 +1,27 @@
 import os
 import sys
+import yaml
 import click
 import socket
 import logging
 from pathlib import Path
 
-from gwtool.utils import run_as_root, single_instance, copyfile, xrun
+from gwtool.utils import run_as_root, single_instance, copyfile, xrun, xcall_graph, Command
 from gwtool.env import env
 from gwtool import libgw
 
 
 @click.group('cli')
-def cli():
+@click.pass_context
+def cli(ctx):
     # if platform is not linux, run_as_root(), single_instance() will fail.
     if sys.platform != 'linux':
         raise Exception('This script can only be run on linux.')
 
+    # render and verify run offline on a build machine, they load configs, inventories and plans by themselves
+    if ctx.invoked_subcommand in ('render', 'verify'):
+        return
+
     run_as_root()
     single_instance()
 
@@ -52,10 +58,29 @@ def cli_setup_firewall():
     setup_route()
 
 
+@cli_setup.command('flowtable')
+def cli_setup_flowtable():
+    from .setup import setup_flowtable
+    setup_flowtable()
+
+
 @cli_setup.command('route')
-def cli_setup_route():
+@click.option('--plan', type=click.Path(exists=True, dir_okay=False), help='Apply a plan rendered by `gw render`.')
+def cli_setup_route(plan):
     from .setup import setup_route
-    setup_route()
+    setup_route(plan)
+
+
+@cli_setup.command('wireguard')
+def cli_setup_wireguard():
+    from .setup import setup_wireguard
+    setup_wireguard()
+
+
+@cli_setup.command('qdisc')
+def cli_setup_qdisc():
+    from .setup import setup_qdisc
+    setup_qdisc()
 
 
 @cli_setup.command('portmap')
@@ -70,6 +95,87 @@ def cli_setup_ifaces():
     setup_ifaces()
 
 
+@cli.group('tune', invoke_without_command=True)
+@click.option('--apply', is_flag=True, help='Write and load the sysctl values.')
+@click.pass_context
+def cli_tune(ctx, apply):
+    """Size conntrack, hash buckets and neighbour limits from RAM and wan capacity."""
+    if ctx.invoked_subcommand is not None:
+        return
+
+    from gwtool.tune import sizing, apply_sizing
+    values = sizing()
+    for key, value, reason in values:
+        click.echo(f'{key}={value}  # {reason}')
+    if apply:
+        apply_sizing(values)
+
+
+@cli_tune.command('monitor')
+@click.option('-i', '--interval', default=5, show_default=True, help='Seconds between samples.')
+@click.option('-c', '--count', default=0, show_default=True, help='Number of samples, 0 for until interrupted.')
+def cli_tune_monitor(interval, count):
+    """Report conntrack fill ratio, insert failures and drops."""
+    from gwtool.tune import monitor
+    monitor(interval, count, echo=click.echo)
+
+
+@cli.command('rules')
+def cli_rules():
+    """Show how user defined rules compile into nftables maps, without applying."""
+    from gwtool.rules import compile_rules
+    from .setup import used_mark_bits
+    compiled = compile_rules([rr.rule for rr in env.gwconfig.route_rules], used_mark_bits())
+    click.echo(compiled.report())
+    click.echo('\n'.join(compiled.ip_rules))
+    click.echo(''.join(compiled.nft))
+
+
+@cli.command('inventory')
+@click.option('-o', '--output', type=click.File('w'), default='-', help='Output file, default stdout.')
+def cli_inventory(output):
+    """Record interfaces referenced by config, for rendering plans with `gw render`."""
+    yaml.safe_dump(libgw.Interface.inventory(), output, default_flow_style=False)
+
+
+@cli.command('render')
+@click.option('--host', 'hosts', nargs=3, multiple=True, required=True,
+              metavar='NAME CONFIG INVENTORY', help='Host name, its gateway.yaml and recorded inventory.')
+@click.option('-o', '--output-dir', default='.', show_default=True, help='Directory to write {name}.batch to.')
+@click.option('-j', '--jobs', type=int, default=None, help='Worker processes, default cpu count.')
+def cli_render(hosts, output_dir, jobs):
+    """Render route plans of many gateways offline."""
+    from .render import render
+    render(hosts, output_dir, jobs)
+
+
+@cli.command('verify')
+@click.argument('old', type=click.Path(exists=True, dir_okay=False))
+@click.argument('new', type=click.Path(exists=True, dir_okay=False))
+@click.option('--samples', default=100000, show_default=True, help='Random IPv4 destinations to check.')
+@click.option('--exhaustive/--no-exhaustive', default=True, show_default=True,
+              help='Also check the boundary addresses of every route prefix.')
+@click.option('--seed', type=int, default=None, help='Random seed for samples.')
+def cli_verify(old, new, samples, exhaustive, seed):
+    """Compare forwarding decisions of two plans rendered by `gw render`, offline."""
+    from gwtool.simulator import load_plan, compare, describe
+    checked, mismatched, examples = compare(load_plan(old), load_plan(new), samples, exhaustive, seed)
+    for dst, src, iif, mark, before, after in examples:
+        click.echo(f'{dst} from {src or "any"} iif {iif or "local"} mark {mark:#x}: '
+                   f'{describe(before)} -> {describe(after)}')
+    click.echo(f'{mismatched} of {checked} lookups differ.')
+    if mismatched:
+        sys.exit(1)
+
+
+@cli.command('watch')
+@click.option('--quiet-period', default=1.0, show_default=True, help='Seconds files must be quiet before applying.')
+@click.option('--min-interval', default=5.0, show_default=True, help='Minimal seconds between two applies.')
+def cli_watch(quiet_period, min_interval):
+    from .watch import watch
+    watch(quiet_period=quiet_period, min_interval=min_interval)
+
+
 @cli.group('install')
 def install():
     pass
@@ -81,17 +187,20 @@ def install_coredns():
     corefile = env.workspace / 'configs' / 'Corefile'
 
     copyfile(datadir / 'coredns.bin', '/usr/local/bin/coredns')
-    xrun('chmod +x /usr/local/bin/coredns')
     copyfile(datadir / 'coredns-sysusers.conf', '/usr/lib/sysusers.d/coredns.conf')
     copyfile(datadir / 'coredns-tmpfiles.conf', '/usr/lib/tmpfiles.d/coredns.conf')
     copyfile(datadir / 'coredns.service', '/etc/systemd/system/coredns.service')
     copyfile(datadir / 'Corefile', corefile, backup=True)
-    xrun('mkdir -p /etc/coredns')
-    xrun(f'ln -snf {corefile} /etc/coredns/Corefile')
-    xrun('systemd-sysusers')
-    xrun('systemd-tmpfiles --create')
-    xrun('systemctl daemon-reload')
-    xrun('systemctl enable --now coredns')
+    xcall_graph([
+        Command('chmod', 'chmod +x /usr/local/bin/coredns'),
+        Command('mkdir', 'mkdir -p /etc/coredns'),
+        Command('link', f'ln -snf {corefile} /etc/coredns/Corefile', after=['mkdir']),
+        Command('sysusers', 'systemd-sysusers'),
+        # tmpfiles may create paths owned by users created by sysusers
+        Command('tmpfiles', 'systemd-tmpfiles --create', after=['sysusers']),
+        Command('daemon-reload', 'systemctl daemon-reload'),
+        Command('enable', 'systemctl enable --now coredns', after=['chmod', 'link', 'tmpfiles', 'daemon-reload']),
+    ])
 
 
 @install.command('vlmcsd')
@@ -99,16 +208,18 @@ def install_vlmcsd():
     datadir = env.codespace / 'install' / 'vlmcsd'
 
     copyfile(datadir / 'vlmcsd.bin', '/usr/local/bin/vlmcsd')
-    xrun('chmod +x /usr/local/bin/vlmcsd')
     copyfile(datadir / 'vlmcsd-sysusers.conf', '/usr/lib/sysusers.d/vlmcsd.conf')
     copyfile(datadir / 'vlmcsd-tmpfiles.conf', '/usr/lib/tmpfiles.d/vlmcsd.conf')
     copyfile(datadir / 'vlmcsd.service', '/etc/systemd/system/vlmcsd.service')
-    xrun('systemd-sysusers')
-    xrun('systemd-tmpfiles --create')
-    xrun('mkdir -p /var/log/vlmcsd')
-    xrun('chown vlmcsd:vlmcsd /var/log/vlmcsd')
-    xrun('systemctl daemon-reload')
-    xrun('systemctl enable --now vlmcsd')
+    xcall_graph([
+        Command('chmod', 'chmod +x /usr/local/bin/vlmcsd'),
+        Command('sysusers', 'systemd-sysusers'),
+        Command('tmpfiles', 'systemd-tmpfiles --create', after=['sysusers']),
+        Command('mkdir', 'mkdir -p /var/log/vlmcsd'),
+        Command('chown', 'chown vlmcsd:vlmcsd /var/log/vlmcsd', after=['sysusers', 'mkdir']),
+        Command('daemon-reload', 'systemctl daemon-reload'),
+        Command('enable', 'systemctl enable --now vlmcsd', after=['chmod', 'tmpfiles', 'chown', 'daemon-reload']),
+    ])
 
 
 @install.command('dnsmasq')
@@ -138,7 +249,10 @@ def install_dnsmasq():
 
 @install.command('sysctl')
 def install_sysctl():
+    from gwtool.tune import sizing, apply_sizing
     copyfile(env.codespace / 'install/sysctl/99-gateway.conf', '/etc/sysctl.d/99-gateway.conf')
+    # conntrack and neighbour limits depend on this box, same as `gw tune --apply`
+    apply_sizing(sizing())
 
 
 @install.command('collectd')
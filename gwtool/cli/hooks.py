@@ -27,6 +27,20 @@ def ifaceup():
         logger.info(f'setting iface group, iface={ifname} group={iface.config.devgroup}')
         xcall(['ip', 'link', 'set', 'dev', ifname, 'group', str(iface.config.devgroup)])
 
+    if iface.config and iface.config.qdisc:
+        from gwtool.qdisc import apply_qdisc
+        apply_qdisc(iface)
+
     from .setup import setup_firewall, setup_route
     setup_firewall()
     setup_route()
+
+
+def ifacedown():
+    env.configure()
+    logger.info(f'Running: {" ".join(sys.argv)}')
+    libgw.load()
+
+    # the link is leaving, rebuild the flowtable device list without it
+    from .setup import setup_flowtable
+    setup_flowtable()
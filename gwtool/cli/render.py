@@ -0,0 +1,71 @@
+import os
+import yaml
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from gwtool.env import env, logger
+from gwtool.config import Config
+from gwtool import libgw
+
+
+# {file: cidr_list} of all zone files, parsed once in the parent process. Workers are forked after this is
+# filled, so they share the parsed zones instead of parsing them again.
+_parsed_netzones = {}
+
+
+def parse_netzones(configs):
+    for config in configs:
+        for path in config.netzone_search_path:
+            if not path.exists():
+                logger.warning(f'netzone search path does not exist: {path}')
+                continue
+            for file in path.iterdir():
+                if file.name.endswith('.txt') and file not in _parsed_netzones:
+                    _parsed_netzones[file] = libgw.NetZone.parse(file)
+
+
+def render_host(name, config, inventory_file):
+    from .setup import route_plan, route_rules_nft, compile_route_rules
+
+    with Path(inventory_file).open(encoding='utf8') as fp:
+        inventory = yaml.safe_load(fp) or {}
+
+    # a worker may render several hosts, start from a clean state for each
+    libgw.reset()
+    env.set_gwconfig(config)
+    libgw.load_offline(inventory, _parsed_netzones)
+
+    compiled = compile_route_rules()
+    lines = [f'# gwtool route plan for {name}, apply with: gw setup route --plan <this file>\n']
+    lines.extend(route_plan(compiled))
+    return name, lines, route_rules_nft(compiled)
+
+
+def render(hosts, output_dir, jobs=None):
+    """
+    Render route plan of each host into {output_dir}/{name}.batch and {name}.nft,
+    hosts is list of (name, config, inventory).
+
+    Runs offline, no root access nor kernel state is needed. Hosts are rendered in parallel by a process pool.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    configs = {name: Config(Path(config_file)) for (name, config_file, _) in hosts}
+    parse_netzones(configs.values())
+    logger.info(f'[render] parsed {len(_parsed_netzones)} netzone files')
+
+    # fork, so workers inherit the parsed netzones
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), mp_context=context) as executor:
+        futures = [executor.submit(render_host, name, configs[name], inventory) for (name, _, inventory) in hosts]
+        for future in futures:
+            name, lines, nft = future.result()
+            artifact = output_dir / f'{name}.batch'
+            with artifact.open('w', encoding='ascii') as fp:
+                fp.write(''.join(lines))
+            # nftables part is picked up from next to the plan by `gw setup route --plan`
+            with artifact.with_suffix('.nft').open('w', encoding='ascii') as fp:
+                fp.write(''.join(nft))
+            logger.info(f'[render] {name}: {len(lines) - 1} commands -> {artifact}')
@@ -1,8 +1,16 @@
 import tempfile
+from pathlib import Path
+from contextlib import nullcontext
 
 from gwtool.env import env, logger
-from gwtool.utils import is_valid_cidr, xcall, xrun, iprule, iproute
-from gwtool.libgw import Gateway, NetZone
+from gwtool.utils import is_valid_cidr, xcall, xrun, xcall_graph, Command, ip, iproute
+from gwtool.libgw import Interface, Gateway, NetZone
+from gwtool.wireguard import sync_plan, table_routes, table_route_lines
+from gwtool.rules import compile_rules, nft_mark_bits
+from gwtool.conntrack import flush_on_move
+from gwtool.flowtable import flowtable_devices, flowtable_nft
+from gwtool.qdisc import apply_qdisc
+from gwtool.minimize import minimize_routes, parse_prefix
 
 
 def setup_firewall():
@@ -11,23 +19,216 @@ def setup_firewall():
     # run "nft -f {script}", in case firewall_script has no exec bit set
     xrun(f'/usr/sbin/nft -f {script}')
 
+    # firewall script flushes the whole ruleset, fast path table has to be created again
+    setup_flowtable()
 
-def setup_route():
+
+def setup_flowtable():
+    logger.info('running setup_flowtable()')
+    devices = env.gwconfig.flowtable and flowtable_devices() or []
+    logger.info(f'flowtable devices: {", ".join(devices) or "none"}')
+    apply_nft_script(flowtable_nft(devices))
+
+
+def setup_route(plan=None):
+    """
+    Setup route tables and rules, from a plan rendered by `gw render` if given.
+    """
     logger.info('running setup_route()')
+    with flush_conntrack_on_move(route_table_ids()):
+        # main table usually has no default route any more, so this is kept out of batches which log failures
+        iproute('delete default table main', silence_error=True)
+        if plan:
+            # nftables part of the plan, rendered next to it
+            nft_plan = Path(plan).with_suffix('.nft')
+            if nft_plan.exists():
+                apply_nft_script(nft_plan)
+            apply_route_plan(plan)
+        else:
+            apply_route_graph()
+
+
+def route_table_ids():
+    tables = set(env.gwconfig.route_tables)
+    for wg in env.gwconfig.wireguard.values():
+        tables.update(wg.tables)
+    return sorted(tables, key=str)
+
+
+def flush_conntrack_on_move(tables):
+    """
+    Context which flushes conntrack entries of prefixes moved to other interfaces by the body, if enabled.
+    """
+    if not env.gwconfig.flush_conntrack:
+        return nullcontext()
+    mark, mark_mask = env.gwconfig.flush_conntrack_mark or (None, 0xffffffff)
+    return flush_on_move(tables, mark, mark_mask)
+
+
+def apply_route_graph():
+    compiled = compile_route_rules()
+    parts = route_plan_parts(compiled)
+
+    # tables are independent, build them concurrently, rules are set up after all tables are done. With -force a
+    # single bad route fails a table batch, rules are set up anyway, as they were before batches.
+    commands = []
+    for name, lines in parts.items():
+        if name != 'rules':
+            commands.append(Command(name, ip.command('-force -batch -'), input=''.join(lines)))
+    commands.append(Command('rules-nft', ['/usr/sbin/nft', '-f', '-'], input=''.join(route_rules_nft(compiled))))
+    # compiled rules match marks set by the nftables table only
+    commands.append(Command('rules', ip.command('-force -batch -'), input=''.join(parts['rules']),
+                            after=compiled and ['rules-nft'] or [], wait=[cmd.name for cmd in commands]))
+    results = xcall_graph(commands)
+    failed = [r.name for r in results.failed + results.skipped]
+    if failed:
+        logger.error(f'setup_route() failed steps: {", ".join(failed)}')
+
+
+def setup_route_rules():
+    logger.info('running setup_route_rules()')
+    compiled = compile_route_rules()
+    apply_nft_script(route_rules_nft(compiled))
+    apply_route_plan(route_rules_plan(compiled))
+
+
+def compile_route_rules():
+    """
+    Compile user defined rules if enabled by `routing.compile_rules`, returns None otherwise.
+    """
+    if not env.gwconfig.compile_route_rules:
+        return None
+    compiled = compile_rules([rr.rule for rr in env.gwconfig.route_rules], used_mark_bits())
+    logger.info(compiled.report())
+    return compiled
+
+
+def used_mark_bits():
+    """
+    Mark bits set or matched by the firewall, custom nftables chains and wireguard devices, see compile_rules().
+    """
+    bits = 0
+    paths = [Path(env.gwconfig.firewall_script or env.codespace / 'nftables' / 'firewall.nft')]
+    # rendering offline has no workspace, and the firewall of the host is not around
+    workspace = getattr(env, 'workspace', None)
+    if workspace:
+        paths.extend(sorted((workspace / 'nftables').glob('*.nft')))
+    for path in paths:
+        try:
+            with path.open(encoding='utf8') as fp:
+                bits |= nft_mark_bits(fp)
+        except OSError:
+            continue
+    for wg in env.gwconfig.wireguard.values():
+        if wg.fwmark:
+            bits |= wg.fwmark
+    return bits
+
+
+def route_plan(compiled=None):
+    """
+    Commands in `ip -batch` format which setup all user defined tables and rules.
+    """
+    lines = []
+    for part in route_plan_parts(compiled).values():
+        lines.extend(part)
+    return lines
+
+
+def route_plan_parts(compiled=None):
+    """
+    route_plan() split into independent parts: one per table, and rules last. The default route of table main is
+    deleted by setup_route() on its own, it does not exist in most runs.
+    """
     # create user defined tables
+    parts = {}
     for table in env.gwconfig.route_tables.values():
-        create_route_table(table.table, table.entries)
+        parts[f'table-{table.table}'] = route_table_plan(table.table, table.entries)
+
+    # tables only used by wireguard peers are not flushed, peer routes are replaced in place
+    for table in sorted({t for wg in env.gwconfig.wireguard.values() for t in wg.tables}):
+        if table not in env.gwconfig.route_tables:
+            parts[f'table-{table}'] = table_route_lines(table)
+
+    parts['rules'] = route_rules_plan(compiled)
+    return parts
 
-    # delete default route in table main
-    iproute('delete default table main', silence_error=True)
 
+def route_rules_plan(compiled=None):
     # flush ip rules
-    flush_iprule()
-    iprule('add from all lookup main pref 50')
+    lines = flush_iprule_plan()
+    lines.append('rule add from all lookup main pref 50\n')
 
     # apply user defined rules
-    for rr in env.gwconfig.route_rules:
-        iprule(f'add {rr.rule}')
+    rules = compiled.ip_rules if compiled else [rr.rule for rr in env.gwconfig.route_rules]
+    for rule in rules:
+        lines.append(f'rule add {rule}\n')
+    return lines
+
+
+def route_rules_nft(compiled=None):
+    """
+    nftables script of compiled rules. Without compiled rules, it only removes a previously created table.
+    """
+    if compiled:
+        return compiled.nft
+    return compile_rules([]).nft
+
+
+def apply_nft_script(script):
+    """
+    Run nftables script, script is either list of lines or path of a rendered script file.
+    """
+    if not isinstance(script, list):
+        xcall(['/usr/sbin/nft', '-f', str(script)])
+        return
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(''.join(script).encode('ascii'))
+        f.flush()
+        xcall(['/usr/sbin/nft', '-f', f.name])
+
+
+def apply_route_plan(plan):
+    """
+    Run plan with `ip -batch`, plan is either list of command lines or path of a rendered plan file.
+    """
+    # -force: keep going on errors like the separate commands did
+    if not isinstance(plan, list):
+        xcall(['ip', '-force', '-batch', str(plan)])
+        return
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(''.join(plan).encode('ascii'))
+        f.flush()
+        xcall(['ip', '-force', '-batch', '-'], stdin=open(f.name))
+
+
+def setup_wireguard():
+    """
+    Sync wireguard peers and route their allowed ips in the same pass.
+    """
+    logger.info('running setup_wireguard()')
+    tables = sorted({t for wg in env.gwconfig.wireguard.values() for t in wg.tables}, key=str)
+    # minimized tables may aggregate peer prefixes, so a removed peer's route can not be deleted on its own,
+    # these tables are rebuilt as a whole after peers are synced
+    rebuilt = []
+    if env.gwconfig.minimize_routes:
+        rebuilt = [table for table in tables if table in env.gwconfig.route_tables]
+    with flush_conntrack_on_move(tables):
+        lines = sync_plan(rebuilt)
+        for table in rebuilt:
+            config = env.gwconfig.route_tables[table]
+            lines.extend(route_table_plan(config.table, config.entries))
+        if lines:
+            apply_route_plan(lines)
+
+
+def setup_qdisc():
+    logger.info('running setup_qdisc()')
+    for ifname, config in env.gwconfig.interfaces.items():
+        if config.qdisc:
+            apply_qdisc(Interface.get(ifname))
 
 
 def setup_portmap():
@@ -47,20 +248,30 @@ def setup_ifaces():
 
 def setup_all():
     setup_ifaces()
+    setup_qdisc()
+    setup_wireguard()
     setup_firewall()
     setup_route()
 
 
-def flush_iprule():
-    iprule('flush')
-    iprule('add from all lookup main pref 32766')
-    iprule('add from all lookup default pref 32767')
+def flush_iprule_plan():
+    return [
+        'rule flush\n',
+        'rule add from all lookup main pref 32766\n',
+        'rule add from all lookup default pref 32767\n',
+    ]
 
 
 def create_route_table(table, entries):
-    iproute(f'flush table {table}')
+    with flush_conntrack_on_move([table]):
+        apply_route_plan(route_table_plan(table, entries))
 
-    lines = []
+
+def route_table_plan(table, entries):
+    lines = [f'route flush table {table}\n']
+
+    # later entries replace earlier ones of the same prefix, just like `ip route replace` did
+    routes = {}
     for (target, gateway_name) in entries:
         gateway = Gateway.get(gateway_name)
         if not gateway:
@@ -72,7 +283,7 @@ def create_route_table(table, entries):
             continue
 
         if is_valid_cidr(target):
-            iproute(f'replace table {table} {target} {gateway.gwdef}')
+            routes[target] = gateway.gwdef
             continue
 
         zone = NetZone.get(target)
@@ -81,13 +292,44 @@ def create_route_table(table, entries):
             continue
 
         for prefix in zone.cidr_list:
-            lines.append(f'route replace table {table} {prefix} {gateway.gwdef}\n')
+            routes[prefix] = gateway.gwdef
+
+    # peer routes replace configured ones of the same prefix, they must be known before minimizing, since
+    # minimized routes around a prefix are only equivalent with the prefix's own route in place
+    routes.update(table_routes(table))
+
+    if env.gwconfig.minimize_routes:
+        routes = minimize_table(table, routes)
+
+    for prefix, gwdef in routes.items():
+        if gwdef is None:
+            # no route here in the original table, lookup falls through to the next rule
+            lines.append(f'route replace table {table} throw {prefix}\n')
+        else:
+            lines.append(f'route replace table {table} {prefix} {gwdef}\n')
 
-    if not lines:
+    if len(lines) == 1:
         logger.warning(f'No rules for table: {table}')
-        return
 
-    with tempfile.NamedTemporaryFile() as f:
-        f.write(''.join(lines).encode('ascii'))
-        f.flush()
-        xcall(['ip', '-batch', '-'], stdin=open(f.name))
+    return lines
+
+
+def minimize_table(table, routes):
+    """
+    Smallest set of routes forwarding every address the same as routes, see gwtool.minimize.
+    """
+    networks = {}
+    for prefix, gwdef in routes.items():
+        try:
+            network = parse_prefix(prefix)
+        except ValueError:
+            logger.warning(f'can not parse prefix in route table {table}: {prefix}, table not minimized')
+            return routes
+        # same network written differently, the later one wins as with `ip route replace`
+        networks.pop(network, None)
+        networks[network] = gwdef
+
+    minimized = minimize_routes(networks)
+    logger.info(f'table {table}: {len(routes)} routes minimized to {len(minimized)}, '
+                f'{len(routes) - len(minimized)} saved')
+    return {str(network): gwdef for network, gwdef in minimized.items()}
@@ -0,0 +1,207 @@
+import time
+from pathlib import Path
+
+from gwtool.env import env, logger
+from gwtool.utils import Inotify, single_instance, release_single_instance, iproute
+from gwtool import libgw
+
+
+# changes in these config sections affect interfaces and gateways, which all route tables depend on
+RESOURCE_SECTIONS = ('interfaces', 'gateways', 'netzone_search_path')
+# routing options changing how every route table is built and applied
+ROUTE_OPTIONS = ('minimize_routes', 'flush_conntrack', 'flush_conntrack_mark')
+
+
+class Changes:
+    """
+    Work to be done for a coalesced burst of file changes.
+    """
+    def __init__(self):
+        self.firewall = False
+        self.flowtable = False
+        self.wireguard = False
+        self.route = False
+        self.rules = False
+        self.tables = set()
+        self.removed_tables = set()
+
+    def __bool__(self):
+        return (self.firewall or self.flowtable or self.wireguard or self.route or self.rules
+                or bool(self.tables) or bool(self.removed_tables))
+
+    def __str__(self):
+        return (f'<Changes firewall={self.firewall} flowtable={self.flowtable} wireguard={self.wireguard} '
+                f'route={self.route} rules={self.rules} tables={sorted(self.tables)} '
+                f'removed_tables={sorted(self.removed_tables)}>')
+
+
+def _watch_paths(inotify):
+    nftables_dir = env.workspace / 'nftables'
+    dirs = [env.config_file.parent, nftables_dir] + list(env.gwconfig.netzone_search_path)
+    if env.gwconfig.firewall_script:
+        dirs.append(Path(env.gwconfig.firewall_script).parent)
+
+    for path in dirs:
+        if not path.is_dir():
+            logger.warning(f'[watch] directory does not exist, not watched: {path}')
+            continue
+        # watching the same directory again returns the existing watch
+        inotify.add_watch(path)
+
+
+def _config_changes(changes):
+    """
+    Compare the config file with the loaded one, returns True if all resources were reloaded.
+    """
+    old = env.gwconfig.content
+    try:
+        new = env.reload_gwconfig().content
+    except Exception:
+        logger.exception('[watch] failed to reload config file, keep using the old one')
+        return False
+
+    if old.get('firewall_entry') != new.get('firewall_entry'):
+        changes.firewall = True
+
+    if old.get('flowtable') != new.get('flowtable'):
+        changes.flowtable = True
+
+    if old.get('wireguard') != new.get('wireguard'):
+        changes.wireguard = True
+
+    # setup_route() only builds configured tables, removed ones are flushed whatever else changed
+    old_routing, new_routing = old.get('routing', {}), new.get('routing', {})
+    old_tables, new_tables = old_routing.get('tables', {}), new_routing.get('tables', {})
+    changes.removed_tables.update(set(old_tables) - set(new_tables))
+
+    if any(old.get(section) != new.get(section) for section in RESOURCE_SECTIONS):
+        libgw.reload()
+        changes.route = True
+        return True
+
+    if any(old_routing.get(option) != new_routing.get(option) for option in ROUTE_OPTIONS):
+        changes.route = True
+        return False
+
+    for table, entries in new_tables.items():
+        if old_tables.get(table) != entries:
+            changes.tables.add(table)
+
+    if any(old_routing.get(key) != new_routing.get(key) for key in ('rules', 'compile_rules')):
+        changes.rules = True
+    return False
+
+
+def _zone_changes(changes, zones):
+    for name in zones:
+        libgw.NetZone.reload(name)
+    for table in env.gwconfig.route_tables.values():
+        if any(target in zones for (target, _) in table.entries):
+            changes.tables.add(table.table)
+
+
+def collect_changes(paths):
+    changes = Changes()
+    nftables_dir = env.workspace / 'nftables'
+
+    reloaded = env.config_file in paths and _config_changes(changes)
+    if not reloaded:
+        # links come and go while watching (pppoe redial, tunnels), never route with a stale snapshot
+        libgw.reload_links()
+
+    firewall_script = env.gwconfig.firewall_script and Path(env.gwconfig.firewall_script)
+    for path in paths:
+        if path.parent == nftables_dir and path.suffix == '.nft':
+            changes.firewall = True
+        elif firewall_script and path == firewall_script:
+            changes.firewall = True
+
+    search_path = env.gwconfig.netzone_search_path
+    zones = {path.stem for path in paths if path.suffix == '.txt' and path.parent in search_path}
+    if zones and not changes.route:
+        _zone_changes(changes, zones)
+
+    return changes
+
+
+def apply_changes(changes):
+    from .setup import (setup_firewall, setup_flowtable, setup_wireguard, setup_route, setup_route_rules,
+                        create_route_table)
+
+    logger.info(f'[watch] applying {changes}')
+
+    # firewall.nft flushes the whole ruleset and includes all *.nft, so it can only be reloaded as a whole.
+    # The flush drops the table of compiled route rules as well, so rules are set up again.
+    if changes.firewall:
+        setup_firewall()
+        changes.rules = True
+    elif changes.flowtable:
+        setup_flowtable()
+
+    # peers are diffed against the live device, only changed peers and their routes are touched
+    if changes.wireguard:
+        setup_wireguard()
+
+    for table in sorted(changes.removed_tables):
+        iproute(f'flush table {table}')
+
+    if changes.route:
+        setup_route()
+        return
+
+    for table in sorted(changes.tables):
+        config = env.gwconfig.route_tables.get(table)
+        if config:
+            create_route_table(config.table, config.entries)
+    if changes.rules:
+        setup_route_rules()
+
+
+def watch(quiet_period=1.0, min_interval=5.0, max_delay=30.0):
+    """
+    Watch config file, netzone search path and nftables include directory, reapply what the changes affect.
+
+    A burst of writes (e.g. editor saving via temp file and rename) is coalesced until files are quiet for
+    quiet_period seconds, but no longer than max_delay. Consecutive applies are at least min_interval apart.
+    """
+    # do not block other gw runs while idle, the lock is only held when applying changes
+    release_single_instance()
+    last_apply = 0
+
+    with Inotify() as inotify:
+        _watch_paths(inotify)
+        logger.info('[watch] waiting for changes')
+
+        while True:
+            paths = set(inotify.read())
+            if not paths:
+                continue
+
+            start = time.monotonic()
+            not_before = last_apply + min_interval
+            while True:
+                now = time.monotonic()
+                if now - start >= max_delay:
+                    break
+                timeout = min(max(quiet_period, not_before - now), start + max_delay - now)
+                more = inotify.read(timeout)
+                if not more:
+                    break
+                paths.update(more)
+
+            logger.info(f'[watch] changed files: {", ".join(sorted(str(p) for p in paths))}')
+
+            single_instance()
+            try:
+                changes = collect_changes(paths)
+                if changes:
+                    apply_changes(changes)
+                    # search path or firewall script may have changed
+                    _watch_paths(inotify)
+                else:
+                    logger.info('[watch] nothing affected')
+            except Exception:
+                logger.exception('[watch] failed to apply changes')
+            finally:
+                release_single_instance()
+            last_apply = time.monotonic()
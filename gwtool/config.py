@@ -1,10 +1,30 @@
 import yaml
+import base64
+import binascii
 import ipaddress
 from pathlib import Path
 
 from gwtool.env import env, logger
 
 
+def parse_bandwidth(value):
+    """
+    Bandwidth in bit/s, from an integer or a string like "800kbit", "20mbit", "1gbit".
+    """
+    if isinstance(value, int):
+        return value
+    units = (('kbit', 1000), ('mbit', 1000 ** 2), ('gbit', 1000 ** 3), ('bit', 1))
+    text = str(value).strip().lower()
+    for unit, multiplier in units:
+        if text.endswith(unit):
+            try:
+                return int(float(text[:-len(unit)]) * multiplier)
+            except ValueError:
+                break
+    logger.error(f'Config Error: invalid bandwidth: {value}')
+    raise ValueError(f'Invalid bandwidth: {value}, must be bit/s or with unit kbit, mbit, gbit')
+
+
 class InterfaceConfig:
     """
     Interfaces can be discovered by pyroute2, however, we can provide more info on how to setup gateway.
@@ -13,8 +33,14 @@ class InterfaceConfig:
     * devgroup: when invoking `ifaceup`, the interface devgroup will be set. Gwtool has 4 forcely defined groups,
                 wan(1), lan(2), guest(3), tunnel(4). These 4 groups can be configured by name, others by number.
     * gateway: Gateway address of this interface. Some interfaces does not need gateway address, like ppp, tun, etc.
+    * qdisc: root queueing discipline set by `ifaceup` and `gw setup qdisc`, "cake" or "fq_codel".
+    * bandwidth: shaping rate of cake, bit/s or string like "20mbit". Usually a bit below the link's uplink rate.
+    * overhead: per packet overhead in bytes cake accounts for, e.g. 34 for pppoe over ethernet.
     """
-    def __init__(self, name, devgroup=None, gateway=None, table=None, **kwargs):
+    QDISC_KINDS = ('cake', 'fq_codel')
+
+    def __init__(self, name, devgroup=None, gateway=None, table=None, qdisc=None, bandwidth=None, overhead=None,
+                 **kwargs):
         self.name = name
 
         # TODO Support user defined group names in /etc/iproute2/group
@@ -34,6 +60,20 @@ class InterfaceConfig:
                 raise
         self.gateway = gateway
 
+        if qdisc is not None and qdisc not in self.QDISC_KINDS:
+            logger.error(f'[InterfaceConfig] Invalid qdisc value: {qdisc}')
+            raise ValueError(f'Invalid qdisc value: {qdisc}, must be one of {", ".join(self.QDISC_KINDS)}')
+        # fq_codel has no shaper, shaping at a rate is done by cake
+        if qdisc != 'cake' and (bandwidth is not None or overhead is not None):
+            logger.error(f'[InterfaceConfig] bandwidth and overhead require qdisc cake: {name}')
+            raise ValueError('"bandwidth" and "overhead" can only be used with qdisc "cake"')
+        self.qdisc = qdisc
+        self.bandwidth = bandwidth is not None and parse_bandwidth(bandwidth) or None
+        if overhead is not None and not (isinstance(overhead, int) and -64 <= overhead <= 256):
+            logger.error(f'[InterfaceConfig] Invalid overhead value: {overhead}')
+            raise ValueError(f'Invalid overhead value: {overhead}, must be integer in [-64, 256]')
+        self.overhead = overhead
+
     def validate(self, **kwargs):
         return True
 
@@ -102,6 +142,98 @@ class RouteRuleConfig:
         return True
 
 
+def _check_wg_key(key, what):
+    try:
+        valid = len(base64.b64decode(key, validate=True)) == 32
+    except (binascii.Error, TypeError):
+        valid = False
+    if not valid:
+        logger.error(f'[WireGuardConfig] Invalid {what}, must be base64 encoded 32 bytes key')
+        raise ValueError(f'Invalid {what}: {key}')
+    return key
+
+
+class WireGuardPeerConfig:
+    """
+    A peer of a WireGuard interface.
+
+    * public_key: (required) base64 encoded public key of the peer.
+    * preshared_key: optional base64 encoded preshared key.
+    * endpoint: optional "host:port" of the peer, ipv6 host in brackets, e.g. "[::1]:51820".
+    * persistent_keepalive: optional keepalive interval in seconds.
+    * allowed_ips: list of cidrs, they are also routed to the interface in the tables of the interface.
+    """
+    def __init__(self, name, public_key=None, preshared_key=None, endpoint=None, persistent_keepalive=None,
+                 allowed_ips=None, **kwargs):
+        self.name = name
+
+        if not public_key:
+            logger.error(f'[WireGuardPeerConfig] public_key is required for peer: {name}')
+            raise ValueError(f'public_key is required for peer: {name}')
+        self.public_key = _check_wg_key(public_key, f'public_key of peer {name}')
+        self.preshared_key = preshared_key and _check_wg_key(preshared_key, f'preshared_key of peer {name}')
+
+        self.endpoint = None
+        if endpoint:
+            host, _, port = endpoint.rpartition(':')
+            host = host.strip('[]')
+            try:
+                # canonical form, as the kernel reports it, e.g. 2001:db8::1 for 2001:DB8::1
+                host = str(ipaddress.ip_address(host))
+                port = int(port)
+            except ValueError:
+                logger.error(f'[WireGuardPeerConfig] Invalid endpoint (must be ip:port): {endpoint}')
+                raise
+            self.endpoint = (host, port)
+
+        self.persistent_keepalive = persistent_keepalive
+
+        # canonical form, as the kernel reports them (e.g. fd00::/64 for FD00::/64), so unchanged peers compare equal
+        self.allowed_ips = []
+        for cidr in allowed_ips or []:
+            try:
+                self.allowed_ips.append(str(ipaddress.ip_network(cidr)))
+            except ValueError:
+                logger.error(f'[WireGuardPeerConfig] Invalid allowed_ips of peer {name}: {cidr}')
+                raise
+
+
+class WireGuardConfig:
+    """
+    A WireGuard interface and its peers, gwtool syncs the live device to it.
+
+    * private_key / private_key_file: private key of the interface, or a file containing it.
+    * listen_port: optional udp port to listen on.
+    * fwmark: optional fwmark for packets sent by the interface.
+    * tables: route tables the peers' allowed_ips are routed to this interface in.
+    * peers: peer name -> WireGuardPeerConfig, names are only for readability.
+    """
+    def __init__(self, name, private_key=None, private_key_file=None, listen_port=None, fwmark=None,
+                 tables=None, peers=None, **kwargs):
+        self.name = name
+
+        if private_key and private_key_file:
+            logger.error('[WireGuardConfig] private_key and private_key_file are exclusive')
+            raise ValueError('"private_key" and "private_key_file" can not be used together')
+        self.private_key = private_key and _check_wg_key(private_key, f'private_key of {name}')
+        # read on sync only, the file is usually readable by root only
+        self.private_key_file = private_key_file and Path(private_key_file)
+
+        self.listen_port = listen_port
+        self.fwmark = fwmark
+        self.tables = tables or []
+
+        self.peers = {}
+        for peer_name, config in (peers or {}).items():
+            self.peers[peer_name] = WireGuardPeerConfig(peer_name, **config)
+
+    def get_private_key(self):
+        if self.private_key_file:
+            with self.private_key_file.open(encoding='ascii') as fp:
+                return _check_wg_key(fp.read().strip(), f'private_key_file of {self.name}')
+        return self.private_key
+
+
 class Config:
     """
     Represents the whole gateway.yaml config file
@@ -119,6 +251,9 @@ class Config:
             logger.info(f'Config file does not exist: {config_file}, assume empty config')
             content = {}
 
+        # raw content is kept for comparing with a reloaded config
+        self.content = content
+
         self.interfaces = {}
         for name, config in content.get('interfaces', {}).items():
             self.interfaces[name] = InterfaceConfig(name, **config)
@@ -134,6 +269,28 @@ class Config:
         self.route_rules = []
         for rule in content.get('routing', {}).get('rules', []):
             self.route_rules.append(RouteRuleConfig(rule=rule))
+        # replace each table's routes by the smallest equivalent set, see gwtool.minimize
+        self.minimize_routes = content.get('routing', {}).get('minimize_routes', False)
+
+        # compile source and iif based rules into nftables maps, see gwtool.rules
+        self.compile_route_rules = content.get('routing', {}).get('compile_rules', False)
+
+        # after routes moved to other interfaces, flush their masquerade conntrack entries, see gwtool.conntrack
+        self.flush_conntrack = content.get('routing', {}).get('flush_conntrack', True)
+        # only flush entries matching this ct mark, "mark" or "mark/mask"
+        self.flush_conntrack_mark = None
+        mark = content.get('routing', {}).get('flush_conntrack_mark', None)
+        if mark is not None:
+            try:
+                mark, _, mask = str(mark).partition('/')
+                self.flush_conntrack_mark = (int(mark, 0), int(mask or '0xffffffff', 0))
+            except ValueError:
+                logger.error(f'Config Error: invalid flush_conntrack_mark: {mark}')
+                raise
+
+        self.wireguard = {}
+        for name, config in content.get('wireguard', {}).items():
+            self.wireguard[name] = WireGuardConfig(name, **config)
 
         netzone_search_path = []
         paths = content.get('netzone_search_path', [])
@@ -147,6 +304,9 @@ class Config:
 
         self.firewall_script = content.get('firewall_entry', None)
 
+        # offload established forwarded flows of wan, lan and tunnel interfaces to an nftables flowtable
+        self.flowtable = content.get('flowtable', True)
+
     def validate(self, **kwargs):
         for interface in self.interfaces.values():
             interface.validate(**kwargs)
@@ -0,0 +1,157 @@
+import socket
+import ipaddress
+from contextlib import contextmanager
+from pyroute2 import IPRoute, Conntrack
+
+from gwtool.env import logger
+from gwtool.libgw import local_address
+
+
+# RTN_UNICAST, other route types (throw, unreachable, ...) do not send packets out of an interface
+RTN_UNICAST = 1
+# IPS_SRC_NAT, set on masqueraded / snat-ed entries
+IPS_SRC_NAT = 1 << 4
+
+
+def _route_oifs(route):
+    multipath = route.get_attr('RTA_MULTIPATH')
+    if multipath:
+        return frozenset(nh['oif'] for nh in multipath)
+    oif = route.get_attr('RTA_OIF')
+    return frozenset([oif]) if oif else frozenset()
+
+
+def snapshot_tables(tables):
+    """
+    {table: {network: frozenset(oif)}} of the given kernel route tables. Non-unicast routes (e.g. throw routes of
+    minimized tables) are kept with no oif, they hide covering routes from longest prefix match.
+    """
+    snapshot = {}
+    with IPRoute() as ipr:
+        for table in tables:
+            routes = {}
+            for family in (socket.AF_INET, socket.AF_INET6):
+                for route in ipr.get_routes(family=family, table=table):
+                    dst = route.get_attr('RTA_DST') or (family == socket.AF_INET and '0.0.0.0' or '::')
+                    oifs = route['type'] == RTN_UNICAST and _route_oifs(route) or frozenset()
+                    routes[ipaddress.ip_network(f'{dst}/{route["dst_len"]}')] = oifs
+            snapshot[table] = routes
+    return snapshot
+
+
+def _key(network, prefixlen):
+    # integer key of network truncated to prefixlen, much cheaper than ip_network.supernet()
+    host_bits = network.max_prefixlen - prefixlen
+    return (network.version, prefixlen, int(network.network_address) >> host_bits)
+
+
+def _index(routes):
+    return {_key(network, network.prefixlen): oifs for network, oifs in routes.items()}
+
+
+def _lookup(index, network):
+    """
+    Longest prefix match of network (as a whole) in indexed routes, returns the oifs or an empty set.
+    """
+    for prefixlen in range(network.prefixlen, -1, -1):
+        oifs = index.get(_key(network, prefixlen))
+        if oifs is not None:
+            return oifs
+    return frozenset()
+
+
+def moved_prefixes(old, new):
+    """
+    {network: old oifs} of address ranges which were routed out of other interfaces before, unmoved prefixes
+    nested in them map to an empty set.
+
+    Every boundary of a range is a prefix in either table, so comparing the lookup of each prefix in both tables
+    covers all addresses, no matter how routes were split or merged.
+    """
+    old_index, new_index = _index(old), _index(new)
+    networks = set(old) | set(new)
+    moved = {}
+    for network in networks:
+        old_oifs = _lookup(old_index, network)
+        if old_oifs and old_oifs != _lookup(new_index, network):
+            moved[network] = old_oifs
+
+    # a moved prefix stands only for its addresses not covered by more specific prefixes, those which did not move
+    # are kept as holes with no oif, so longest prefix match in flush_moved() stops there
+    moved_index = _index(moved)
+    for network in networks - set(moved):
+        if _lookup(moved_index, network):
+            moved[network] = frozenset()
+    return moved
+
+
+def _interface_addresses(oifs):
+    addresses = set()
+    with IPRoute() as ipr:
+        for oif in oifs:
+            for addr in ipr.get_addr(index=oif):
+                # masquerade picks the local address, which is not IFA_ADDRESS on pppoe
+                addresses.add(ipaddress.ip_address(local_address(addr)))
+    return addresses
+
+
+def flush_moved(moved, mark=None, mark_mask=0xffffffff):
+    """
+    Delete conntrack entries which were masqueraded out of an interface their destination is not routed to anymore.
+    moved is a list of moved_prefixes() results, one per table, as holes of one table do not apply to others.
+
+    Only entries to moved prefixes, nat-ed to an address of the old interface (and matching mark if given) are
+    deleted, so unaffected flows keep their state. The mark filter is done by kernel.
+    """
+    oifs = set().union(*[oifs for table in moved for oifs in table.values()])
+    if not oifs:
+        return 0
+
+    addresses = _interface_addresses(oifs)
+    if not addresses:
+        # old interfaces are gone, kernel already dropped their masquerade entries
+        return 0
+
+    indexes = [_index(table) for table in moved]
+
+    def is_moved(daddr):
+        network = ipaddress.ip_network(ipaddress.ip_address(daddr))
+        return any(_lookup(index, network) for index in indexes)
+
+    with Conntrack() as ct:
+        stale = []
+        for entry in ct.dump_entries(mark=mark, mark_mask=mark_mask):
+            if not entry.status & IPS_SRC_NAT:
+                continue
+            if ipaddress.ip_address(entry.tuple_reply.daddr) not in addresses:
+                continue
+            if is_moved(entry.tuple_orig.daddr):
+                stale.append(entry)
+
+        # delete after the dump, deleting while dumping may skip entries
+        for entry in stale:
+            ct.entry('del', tuple_orig=entry.tuple_orig)
+
+    return len(stale)
+
+
+@contextmanager
+def flush_on_move(tables, mark=None, mark_mask=0xffffffff):
+    """
+    Snapshot route tables, run the body which changes them, then flush conntrack entries of moved prefixes.
+    """
+    tables = [table for table in tables if isinstance(table, int)]
+    old = snapshot_tables(tables)
+    yield
+    new = snapshot_tables(tables)
+
+    moved = [moved_prefixes(old[table], new[table]) for table in tables]
+    prefixes = sum(1 for table in moved for oifs in table.values() if oifs)
+
+    if prefixes:
+        try:
+            count = flush_moved(moved, mark, mark_mask)
+        except Exception:
+            logger.exception('failed to flush conntrack entries of moved prefixes')
+            return
+        logger.info(f'{prefixes} prefixes moved to other interfaces, {count} conntrack entries flushed')
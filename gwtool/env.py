@@ -53,6 +53,21 @@ class Env:
         from gwtool.config import Config
         return Config(self.config_file)
 
+    def reload_gwconfig(self):
+        """
+        Load config file again. The current gwconfig is kept if the new one fails to load.
+        """
+        from gwtool.config import Config
+        config = Config(self.config_file)
+        self.set_gwconfig(config)
+        return config
+
+    def set_gwconfig(self, config):
+        """
+        Use the given config instead of loading config file, e.g. when rendering plans for other hosts.
+        """
+        self.__dict__['gwconfig'] = config
+
     def _add_log_stream(self):
         handler = logging.StreamHandler()
         handler.setLevel(logging.DEBUG)
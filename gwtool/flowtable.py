@@ -0,0 +1,48 @@
+from gwtool.libgw import Interface
+
+
+NFT_TABLE = 'fastpath'
+
+# wan, lan and tunnel, guest traffic always goes through the full forward path
+DEVGROUPS = (1, 2, 4)
+
+
+def flowtable_devices():
+    """
+    Names of existing interfaces in the flowtable devgroups, scanned again each time as links come and go.
+    """
+    devices = set()
+    for members in Interface.in_groups(DEVGROUPS, refresh=True).values():
+        devices.update(interface.ifname for interface in members)
+    return sorted(devices)
+
+
+def flowtable_nft(devices):
+    """
+    nftables script (re)creating the fast path table. Without devices, it only removes the table.
+
+    Established tcp/udp flows are added to the flowtable before the firewall forward chain (priority 0) sees them,
+    their following packets are forwarded at ingress, skipping forward chains and the routing decision. Flows of
+    devices removed from the kernel are dropped from the flowtable by kernel itself.
+    """
+    lines = [
+        f'table inet {NFT_TABLE} {{}}\n',
+        f'delete table inet {NFT_TABLE}\n',
+    ]
+    if not devices:
+        return lines
+
+    quoted = ', '.join(f'"{device}"' for device in devices)
+    lines.extend([
+        f'table inet {NFT_TABLE} {{\n',
+        '    flowtable ft {\n',
+        '        hook ingress priority 0;\n',
+        f'        devices = {{ {quoted} }};\n',
+        '    }\n',
+        '    chain forward {\n',
+        '        type filter hook forward priority -1;\n',
+        '        meta l4proto { tcp, udp } ct state established flow add @ft\n',
+        '    }\n',
+        '}\n',
+    ])
+    return lines
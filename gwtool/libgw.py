@@ -1,16 +1,56 @@
 import re
+import errno
 from pyroute2 import IPRoute
+from pyroute2.netlink.exceptions import NetlinkError
 
 from gwtool.utils import cached_property
 from gwtool.env import env, logger
 
 
+def local_address(addr):
+    """
+    Own address of an address message. On point-to-point links (ppp, gre, ...) IFA_ADDRESS is the peer's address,
+    the local one is IFA_LOCAL.
+    """
+    return addr.get_attr('IFA_LOCAL') or addr.get_attr('IFA_ADDRESS')
+
+
+class LinkInfo:
+    """
+    Slim record of a link. Only the attributes gwtool uses are kept, the full netlink message is dropped.
+    """
+    __slots__ = ('index', 'group', 'operstate', 'kind', 'addresses')
+
+    def __init__(self, index, group=0, operstate=None, kind=None, addresses=()):
+        self.index = index
+        self.group = group
+        self.operstate = operstate
+        self.kind = kind
+        # list of 'address/prefixlen' strings
+        self.addresses = list(addresses)
+
+    @classmethod
+    def from_msg(cls, link, addrs=()):
+        return cls(
+            index=link['index'],
+            group=link.get_attr('IFLA_GROUP'),
+            operstate=link.get_attr('IFLA_OPERSTATE'),
+            kind=link.get_nested('IFLA_LINKINFO', 'IFLA_INFO_KIND'),
+            addresses=[f'{local_address(addr)}/{addr["prefixlen"]}' for addr in addrs],
+        )
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
 class Interface:
     def __init__(self, ifname, link, config=None):
         self.ifname = ifname
+        # LinkInfo or None if the link does not exist
         self.link = link
         self.config = config
-        logger.debug(f'Loaded interface: {self}')
+        # formatted only if debug logging is enabled
+        logger.debug('Loaded interface: %s', self)
 
     @cached_property
     def user_configured(self):
@@ -28,20 +68,24 @@ class Interface:
 
     @cached_property
     def index(self):
-        return self.link and self.link['index']
+        return self.link and self.link.index
 
     @cached_property
     def devgroup(self):
-        return self.link and self.link.get_attr('IFLA_GROUP')
+        return self.link and self.link.group
 
     @cached_property
     def operstate(self):
-        return self.link and self.link.get_attr('IFLA_OPERSTATE')
+        return self.link and self.link.operstate
 
     @cached_property
     def link_kind(self):
         # bridge, vlan, tun, tap, gre, ppp, wireguard, ...
-        return self.link and self.link.get_nested('IFLA_LINKINFO', 'IFLA_INFO_KIND')
+        return self.link and self.link.kind
+
+    @cached_property
+    def addresses(self):
+        return self.link.addresses if self.link else []
 
     def get_gwdef(self, gateway=None):
         if not gateway:
@@ -54,6 +98,12 @@ class Interface:
     # ---- 8< ----
 
     _interfaces = {}
+    # names looked up lazily but not found in os, so we do not ask netlink again
+    _missing = set()
+    # devgroups whose members have been scanned
+    _groups = {}
+    # loaded from a recorded inventory instead of netlink, e.g. when rendering plans on a build machine
+    _offline = False
     _loaded = False
 
     def __str__(self):
@@ -62,19 +112,63 @@ class Interface:
 
     __repr__ = __str__
 
+    @classmethod
+    def _referenced_ifnames(cls):
+        """
+        Names of all interfaces referenced by user config, either directly or through gateways and route tables.
+        """
+        gwconfig = env.gwconfig
+        ifnames = set(gwconfig.interfaces)
+        for config in gwconfig.gateways.values():
+            if config.link:
+                continue
+            if config.single_interface_mode:
+                ifnames.add(config.interface)
+            else:
+                ifnames.update(config.interfaces)
+        # route table entries may use an interface name as gateway directly
+        for table in gwconfig.route_tables.values():
+            for (_, gateway_name) in table.entries:
+                if gateway_name not in gwconfig.gateways:
+                    ifnames.add(gateway_name)
+        ifnames.update(gwconfig.wireguard)
+        return ifnames
+
+    @staticmethod
+    def _query_link(ipr, ifname):
+        try:
+            return ipr.link('get', ifname=ifname)[0]
+        except NetlinkError as e:
+            if e.code == errno.ENODEV:
+                return None
+            raise
+
     @classmethod
     def _load_interfaces(cls):
         if cls._loaded:
             return
 
-        # scan all interfaces in os
+        # only ask netlink for interfaces referenced by user config, other interfaces are resolved on first access
+        links = {}
         with IPRoute() as ipr:
-            for link in ipr.get_links():
-                ifname = link.get_attr('IFLA_IFNAME')
-                config = env.gwconfig.interfaces.get(ifname, None)
-                cls._interfaces[ifname] = cls(ifname, link, config)
-
-        # scan all user configured interface and register as well
+            for ifname in sorted(cls._referenced_ifnames()):
+                link = cls._query_link(ipr, ifname)
+                if link is not None:
+                    links[ifname] = link
+
+            # one address dump for all referenced links, instead of one dump per link
+            indexes = {link['index'] for link in links.values()}
+            addrs = {}
+            if indexes:
+                for addr in ipr.get_addr():
+                    if addr['index'] in indexes:
+                        addrs.setdefault(addr['index'], []).append(addr)
+
+        for ifname, link in links.items():
+            config = env.gwconfig.interfaces.get(ifname, None)
+            cls._interfaces[ifname] = cls(ifname, LinkInfo.from_msg(link, addrs.get(link['index'], ())), config)
+
+        # register user configured interfaces which are not found in os as well
         for ifname, config in env.gwconfig.interfaces.items():
             if ifname not in cls._interfaces:
                 logger.warning(f'Link not found for user configured interface: {ifname}')
@@ -82,11 +176,141 @@ class Interface:
 
         cls._loaded = True
 
+    @classmethod
+    def _load_inventory(cls, inventory):
+        """
+        Load interfaces from an inventory recorded by inventory() on the gateway box, netlink is never asked.
+        """
+        if cls._loaded:
+            return
+
+        for ifname, record in inventory.items():
+            cls._interfaces[ifname] = cls(ifname, LinkInfo(**record), env.gwconfig.interfaces.get(ifname, None))
+
+        for ifname, config in env.gwconfig.interfaces.items():
+            if ifname not in cls._interfaces:
+                logger.warning(f'Link not found in inventory for user configured interface: {ifname}')
+                cls._interfaces[ifname] = cls(ifname, None, config)
+
+        cls._offline = True
+        cls._loaded = True
+
+    @classmethod
+    def inventory(cls):
+        """
+        Records of all existing interfaces referenced by user config, which can be loaded by _load_inventory().
+        """
+        if not cls._loaded:
+            raise Exception('Interfaces not loaded, please load interfaces before using inventory()')
+        inventory = {}
+        for ifname in sorted(cls._referenced_ifnames()):
+            interface = cls.get(ifname)
+            if interface and interface.exists:
+                inventory[ifname] = interface.link.as_dict()
+        return inventory
+
+    @classmethod
+    def _lookup(cls, ifname):
+        """
+        Resolve an interface not referenced by user config on its first access.
+        """
+        if cls._offline or ifname in cls._missing:
+            return None
+
+        with IPRoute() as ipr:
+            link = cls._query_link(ipr, ifname)
+            if link is None:
+                cls._missing.add(ifname)
+                return None
+            addrs = ipr.get_addr(index=link['index'])
+
+        interface = cls(ifname, LinkInfo.from_msg(link, addrs), env.gwconfig.interfaces.get(ifname, None))
+        cls._interfaces[ifname] = interface
+        return interface
+
+    @classmethod
+    def refresh(cls, ifname):
+        """
+        Query a link again, e.g. after gwtool created it. Gateways cache their interfaces, so they are rebuilt too.
+        """
+        cls._interfaces.pop(ifname, None)
+        cls._missing.discard(ifname)
+        cls._groups = {}
+        interface = cls._lookup(ifname)
+        if interface is None and ifname in env.gwconfig.interfaces:
+            interface = cls._interfaces[ifname] = cls(ifname, None, env.gwconfig.interfaces[ifname])
+
+        for name, gateway in list(Gateway._gateways.items()):
+            Gateway._gateways[name] = Gateway(name, gateway.config)
+        return interface
+
     @classmethod
     def get(cls, ifname):
         if not cls._loaded:
             raise Exception('Interfaces not loaded, please load interfaces before using get()')
-        return cls._interfaces.get(ifname)
+        interface = cls._interfaces.get(ifname)
+        if interface is None:
+            interface = cls._lookup(ifname)
+        return interface
+
+    @classmethod
+    def in_group(cls, devgroup, refresh=False):
+        """
+        Existing interfaces in the given devgroup. Members are scanned once per group and cached, unless refresh
+        is set, e.g. when links may have come or gone since.
+        """
+        return cls.in_groups([devgroup], refresh)[devgroup]
+
+    @classmethod
+    def in_groups(cls, devgroups, refresh=False):
+        """
+        {devgroup: existing interfaces} of the given devgroups, see in_group(). All groups to scan are scanned by
+        one link dump.
+
+        Kernel does not filter link dumps by group, so the dump is filtered here and only slim records of the
+        matched links are kept.
+        """
+        if not cls._loaded:
+            raise Exception('Interfaces not loaded, please load interfaces before using in_groups()')
+
+        if cls._offline:
+            return {devgroup: [iface for iface in cls._interfaces.values()
+                               if iface.exists and iface.devgroup == devgroup] for devgroup in devgroups}
+
+        scan = {devgroup for devgroup in devgroups if refresh or devgroup not in cls._groups}
+        if scan:
+            members = {devgroup: [] for devgroup in scan}
+            stale = []
+            with IPRoute() as ipr:
+                for link in ipr.get_links():
+                    devgroup = link.get_attr('IFLA_GROUP')
+                    if devgroup not in scan:
+                        continue
+                    ifname = link.get_attr('IFLA_IFNAME')
+                    interface = cls._interfaces.get(ifname)
+                    # a known link may have joined the group after it was loaded, its record is stale then
+                    if interface is None or not interface.exists or interface.devgroup != devgroup:
+                        stale.append((devgroup, ifname, link))
+                    else:
+                        members[devgroup].append(interface)
+
+                # one address dump for all new records, instead of one dump per link
+                addrs = {}
+                if stale:
+                    indexes = {link['index'] for (_, _, link) in stale}
+                    for addr in ipr.get_addr():
+                        if addr['index'] in indexes:
+                            addrs.setdefault(addr['index'], []).append(addr)
+
+            for devgroup, ifname, link in stale:
+                interface = cls(ifname, LinkInfo.from_msg(link, addrs.get(link['index'], ())),
+                                env.gwconfig.interfaces.get(ifname))
+                cls._interfaces[ifname] = interface
+                cls._missing.discard(ifname)
+                members[devgroup].append(interface)
+            cls._groups.update(members)
+
+        return {devgroup: cls._groups[devgroup] for devgroup in devgroups}
 
 
 class Gateway:
@@ -196,18 +420,22 @@ class Gateway:
     def get(cls, name):
         if not cls._loaded:
             raise Exception('Gateways not loaded, please load gateways before using get()')
-        return cls._gateways.get(name)
+        gateway = cls._gateways.get(name)
+        if gateway is None:
+            # interfaces not referenced by user config are resolved lazily, register their gateway on first access
+            interface = Interface.get(name)
+            if interface and interface.exists:
+                gateway = cls._gateways[name] = cls(name, None)
+        return gateway
 
 
 class NetZone:
-    def __init__(self, name, file):
+    def __init__(self, name, file, cidr_list=None):
         self.name = name
         self.file = file
 
-        with file.open(encoding='utf8') as fp:
-            cidr_list = [re.split(';|#| ', line)[0].strip() for line in fp.readlines()]
-            cidr_list = [n for n in cidr_list if n]
-
+        if cidr_list is None:
+            cidr_list = self.parse(file)
         self.cidr_list = cidr_list
 
         logger.debug(f'Loaded NetZone: {self}')
@@ -222,10 +450,20 @@ class NetZone:
 
     __repr__ = __str__
 
+    @staticmethod
+    def parse(file):
+        with file.open(encoding='utf8') as fp:
+            cidr_list = [re.split(';|#| ', line)[0].strip() for line in fp.readlines()]
+            return [n for n in cidr_list if n]
+
     @classmethod
-    def _load_netzones(cls):
+    def _load_netzones(cls, parsed=None):
+        """
+        parsed: optional {file: cidr_list} of already parsed zone files, files not in it are parsed here.
+        """
         if cls._loaded:
             return
+        parsed = parsed or {}
 
         # 扫描所有 netzones 目录并加载
         for path in env.gwconfig.netzone_search_path:
@@ -237,10 +475,31 @@ class NetZone:
                     continue
                 zonename = file.name[:-4]
                 if zonename not in cls._netzones:
-                    cls._netzones[zonename] = cls(zonename, file)
+                    cls._netzones[zonename] = cls(zonename, file, parsed.get(file))
 
         cls._loaded = True
 
+    @classmethod
+    def _find_file(cls, name):
+        for path in env.gwconfig.netzone_search_path:
+            file = path / f'{name}.txt'
+            if file.exists():
+                return file
+
+    @classmethod
+    def reload(cls, name):
+        """
+        Parse a single zone again, e.g. after its file changed. The zone is dropped if no file is found anymore.
+        """
+        if not cls._loaded:
+            raise Exception('NetZone not loaded, please load netzones before using reload()')
+        file = cls._find_file(name)
+        if file is None:
+            cls._netzones.pop(name, None)
+            return None
+        zone = cls._netzones[name] = cls(name, file)
+        return zone
+
     @classmethod
     def get(cls, name):
         if not cls._loaded:
@@ -252,3 +511,48 @@ def load():
     Interface._load_interfaces()
     Gateway._load_gateways()
     NetZone._load_netzones()
+
+
+def load_offline(inventory, parsed_netzones=None):
+    """
+    Load resources without asking the kernel, interfaces come from a recorded inventory.
+    """
+    Interface._load_inventory(inventory)
+    Gateway._load_gateways()
+    NetZone._load_netzones(parsed_netzones)
+
+
+def _reset_links():
+    Interface._interfaces = {}
+    Interface._missing = set()
+    Interface._groups = {}
+    Interface._offline = False
+    Interface._loaded = False
+    Gateway._gateways = {}
+    Gateway._loaded = False
+
+
+def reset():
+    """
+    Drop all loaded resources.
+    """
+    _reset_links()
+    NetZone._netzones = {}
+    NetZone._loaded = False
+
+
+def reload():
+    """
+    Drop all loaded resources and load them again, e.g. after gwconfig is reloaded.
+    """
+    reset()
+    load()
+
+
+def reload_links():
+    """
+    Load interfaces and gateways again, e.g. links came or went. Netzones are kept, they only change with their files.
+    """
+    _reset_links()
+    Interface._load_interfaces()
+    Gateway._load_gateways()
@@ -0,0 +1,104 @@
+import ipaddress
+
+
+# a node without a route of its own, distinct from None which means "no route" (lookup falls to next rule)
+_UNSET = object()
+
+
+class _Node:
+    __slots__ = ('children', 'nexthop', 'candidates')
+
+    def __init__(self):
+        self.children = None
+        self.nexthop = _UNSET
+        self.candidates = None
+
+
+def parse_prefix(text):
+    """
+    ip_network from a route target, also accepting iproute2 short forms like "0/0", "10/8" and "default".
+    """
+    if text == 'default':
+        text = '0.0.0.0/0'
+    try:
+        return ipaddress.ip_network(text, strict=False)
+    except ValueError:
+        address, _, prefixlen = text.partition('/')
+        if ':' in address or not prefixlen:
+            raise
+        octets = address.split('.')
+        octets.extend(['0'] * (4 - len(octets)))
+        return ipaddress.ip_network(f'{".".join(octets)}/{prefixlen}', strict=False)
+
+
+def _insert(root, network, nexthop):
+    node = root
+    value = int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+    for bit in range(network.prefixlen - 1, -1, -1):
+        if node.children is None:
+            node.children = [None, None]
+        branch = (value >> bit) & 1
+        if node.children[branch] is None:
+            node.children[branch] = _Node()
+        node = node.children[branch]
+    node.nexthop = nexthop
+
+
+def _candidates(node, inherited):
+    """
+    Pass 1 and 2 of ORTC: push nexthops down to leaves of a complete trie, then collect candidate sets bottom up.
+    """
+    if node.nexthop is not _UNSET:
+        inherited = node.nexthop
+    if node.children is None:
+        node.candidates = {inherited}
+        return
+    for branch in (0, 1):
+        if node.children[branch] is None:
+            node.children[branch] = _Node()
+        _candidates(node.children[branch], inherited)
+    left, right = node.children[0].candidates, node.children[1].candidates
+    node.candidates = (left & right) or (left | right)
+
+
+def _pick(candidates):
+    # deterministic choice, real nexthops before "no route" so fewer throw routes are emitted
+    return sorted(candidates, key=lambda nexthop: (nexthop is None, str(nexthop)))[0]
+
+
+def _select(node, inherited, value, prefixlen, family, routes):
+    """
+    Pass 3 of ORTC: top down, a node gets a route only if the inherited nexthop is not one of its candidates.
+    """
+    if inherited in node.candidates:
+        chosen = inherited
+    else:
+        chosen = _pick(node.candidates)
+        network_class, max_prefixlen = family
+        routes[network_class((value << (max_prefixlen - prefixlen), prefixlen))] = chosen
+    if node.children is not None:
+        for branch in (0, 1):
+            _select(node.children[branch], chosen, (value << 1) | branch, prefixlen + 1, family, routes)
+
+
+def minimize_routes(routes):
+    """
+    Smallest route table forwarding every address exactly as routes do, by the ORTC algorithm (Draves et al.,
+    "Constructing Optimal IP Routing Tables", 1999).
+
+    routes is {ip_network: nexthop}. The result may contain None nexthops: addresses with no route in the original
+    table inside a prefix aggregated to one nexthop, they have to become `throw` routes so lookup still falls through
+    to the next rule. Covering prefixes with the same nexthop are dropped, and where a zone's complement is smaller,
+    the zone's routes are replaced by a covering route plus routes for the complement.
+    """
+    result = {}
+    for family in ((ipaddress.IPv4Network, 32), (ipaddress.IPv6Network, 128)):
+        family_routes = {network: nexthop for network, nexthop in routes.items() if isinstance(network, family[0])}
+        if not family_routes:
+            continue
+        root = _Node()
+        for network, nexthop in family_routes.items():
+            _insert(root, network, nexthop)
+        _candidates(root, None)
+        _select(root, None, 0, 0, family, result)
+    return result
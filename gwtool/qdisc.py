@@ -0,0 +1,60 @@
+from pyroute2 import IPRoute
+
+from gwtool.env import logger
+
+
+TC_H_ROOT = 0xffffffff
+ROOT_HANDLE = 0x10000
+
+
+def _root_qdisc(ipr, index):
+    for qdisc in ipr.get_qdiscs(index=index):
+        if qdisc['parent'] == TC_H_ROOT:
+            return qdisc
+
+
+def _qdisc_matches(qdisc, config):
+    """
+    If the live root qdisc already is what config asks for, replacing it would only reset its statistics.
+    """
+    if qdisc is None or qdisc.get_attr('TCA_KIND') != config.qdisc:
+        return False
+    if config.qdisc != 'cake':
+        return True
+
+    options = qdisc.get_attr('TCA_OPTIONS')
+    if options is None:
+        return False
+    # kernel reports cake's rate in byte/s
+    if config.bandwidth is not None and options.get_attr('TCA_CAKE_BASE_RATE64') != config.bandwidth >> 3:
+        return False
+    if config.overhead is not None and options.get_attr('TCA_CAKE_OVERHEAD') != config.overhead:
+        return False
+    return True
+
+
+def apply_qdisc(interface):
+    """
+    Set root qdisc of interface from its config, unless the live one already matches. Returns True if changed.
+    """
+    config = interface.config
+    if not config or not config.qdisc:
+        return False
+    if not interface.exists:
+        logger.warning(f'[qdisc] interface does not exist: {interface.ifname}, qdisc skipped')
+        return False
+
+    with IPRoute() as ipr:
+        if _qdisc_matches(_root_qdisc(ipr, interface.index), config):
+            logger.info(f'[qdisc] {interface.ifname}: {config.qdisc} unchanged')
+            return False
+
+        kwargs = {}
+        if config.bandwidth is not None:
+            # pyroute2 takes bit/s
+            kwargs['bandwidth'] = config.bandwidth
+        if config.overhead is not None:
+            kwargs['overhead'] = config.overhead
+        logger.info(f'[qdisc] {interface.ifname}: replace root qdisc with {config.qdisc} {kwargs}')
+        ipr.tc('replace', config.qdisc, interface.index, ROOT_HANDLE, **kwargs)
+        return True
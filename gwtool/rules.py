@@ -0,0 +1,294 @@
+import re
+import shlex
+import ipaddress
+
+from gwtool.env import logger
+
+
+# fwmark bits owned by compiled rules, other bits of the mark are preserved.
+# Source and iif rules use separate bits, so a packet can carry both and ip rules still fall through in order.
+FROM_MARK_MASK = 0x00ff0000
+IIF_MARK_MASK = 0xff000000
+
+NFT_TABLE = 'route_rules'
+
+_PREF_KEYWORDS = ('pref', 'preference', 'priority', 'order')
+_TABLE_KEYWORDS = ('lookup', 'table')
+# tokens which may continue a mark expression in nftables, e.g. `meta mark & 0xff00 == 0x100`, `ct mark set 1`
+_NFT_MARK_TOKENS = ('meta', 'ct', 'mark', 'set', '&', '|', '^', '==', '!=', 'and', 'or', 'xor')
+_NFT_NUMBER = re.compile(r'^(0x[0-9a-fA-F]+|[0-9]+)$')
+
+
+class ParsedRule:
+    """
+    An `ip rule` string, parsed only as far as needed to decide if it can be compiled.
+    """
+    __slots__ = ('rule', 'index', 'pref', 'table', 'source', 'iif', 'mark_mask', 'compilable')
+
+    def __init__(self, rule, index):
+        self.rule = rule
+        self.index = index
+        self.pref = None
+        self.table = None
+        self.source = None
+        self.iif = None
+        # mask of the fwmark selector, None without one
+        self.mark_mask = None
+        self.compilable = False
+
+        tokens = shlex.split(rule)
+        if 'fwmark' in tokens[:-1]:
+            _, _, mask = tokens[tokens.index('fwmark') + 1].partition('/')
+            try:
+                self.mark_mask = int(mask, 0) if mask else 0xffffffff
+            except ValueError:
+                self.mark_mask = 0xffffffff
+
+        selectors = {}
+        while tokens:
+            key = tokens.pop(0)
+            if not tokens:
+                return
+            selectors[key] = tokens.pop(0)
+
+        for key in _PREF_KEYWORDS:
+            if key in selectors:
+                self.pref = selectors.pop(key)
+        for key in _TABLE_KEYWORDS:
+            if key in selectors:
+                self.table = selectors.pop(key)
+        if selectors.get('from') == 'all':
+            selectors.pop('from')
+
+        # any other selector (to, fwmark, not, uidrange, ...) or action keeps the rule as is
+        if not self.pref or not self.table or set(selectors) - {'from', 'iif'} or len(selectors) != 1:
+            return
+
+        if 'from' in selectors:
+            try:
+                network = ipaddress.ip_network(selectors['from'], strict=False)
+            except ValueError:
+                return
+            # `ip rule` without -6 only handles ipv4
+            if network.version != 4:
+                return
+            self.source = network
+        else:
+            # locally generated packets match `iif lo`, which has no equivalent in nftables
+            if selectors['iif'] == 'lo':
+                return
+            self.iif = selectors['iif']
+
+        self.compilable = True
+
+    @property
+    def group(self):
+        return (self.pref, self.table)
+
+
+class CompiledRules:
+    """
+    Result of compile_rules(): ip rules to add, nftables script for the mark maps, and the chain length report.
+    """
+    def __init__(self, ip_rules, nft, before):
+        self.ip_rules = ip_rules
+        self.nft = nft
+        self.before = before
+        self.after = len(ip_rules)
+
+    def report(self):
+        return f'ip rule chain: {self.before} user rules before, {self.after} after compiling'
+
+
+def _overlapped(rules):
+    """
+    Source rules whose prefix overlaps a prefix of another (pref, table) group. A packet matching both would only
+    carry one mark, so these rules are left in the ip rule chain.
+    """
+    overlapped = set()
+    # outer prefix first when two prefixes share the network address, so nested ones are found on the stack
+    rules = sorted(rules, key=lambda r: _prefix_order(r.source))
+    stack = []
+    for rule in rules:
+        while stack and not rule.source.subnet_of(stack[-1].source):
+            stack.pop()
+        for outer in stack:
+            if outer.group != rule.group:
+                overlapped.update([outer.index, rule.index])
+        stack.append(rule)
+    return overlapped
+
+
+def _prefix_order(network):
+    return (int(network.network_address), network.prefixlen)
+
+
+def _mark(value, mask):
+    shift = (mask & -mask).bit_length() - 1
+    return value << shift
+
+
+def nft_mark_bits(lines):
+    """
+    Union of the numbers used in mark expressions of nftables script lines, i.e. bits other chains set or match.
+    """
+    bits = 0
+    for line in lines:
+        tokens = line.split('#', 1)[0].replace(';', ' ').split()
+        for index, token in enumerate(tokens):
+            if token != 'mark':
+                continue
+            for token in tokens[index + 1:]:
+                if _NFT_NUMBER.match(token):
+                    bits |= int(token, 0)
+                elif token not in _NFT_MARK_TOKENS:
+                    break
+    return bits
+
+
+def _mark_conflict(parsed, used_marks):
+    """
+    Reason why compiled marks would change other rules or chains, None if they can not.
+    """
+    reserved = FROM_MARK_MASK | IIF_MARK_MASK
+    for rule in parsed:
+        if rule.mark_mask is not None and rule.mark_mask & reserved:
+            return f'fwmark mask of rule overlaps compiled mark bits {reserved:#010x}: {rule.rule}'
+    if used_marks & reserved:
+        return f'marks used elsewhere ({used_marks:#x}) overlap compiled mark bits {reserved:#010x}'
+    return None
+
+
+def compile_rules(rules, used_marks=0):
+    """
+    Compile source and iif based rules into nftables verdict maps setting fwmark bits, leaving one
+    `fwmark ... lookup T pref P` rule for each (pref, table) group. Other rules are kept as they are.
+
+    Compiled marks are set on every matching packet, so nothing is compiled if other rules or the mark bits in
+    used_marks (firewall chains, wireguard fwmark, ...) may see them.
+    """
+    parsed = [ParsedRule(rule, index) for index, rule in enumerate(rules)]
+
+    conflict = _mark_conflict(parsed, used_marks)
+    if conflict:
+        logger.error(f'route rules not compiled, {conflict}')
+        return CompiledRules(list(rules), _nft_script({}, [], []), len(rules))
+
+    overlapped = _overlapped([r for r in parsed if r.compilable and r.source])
+    iif_groups = {}
+    for rule in parsed:
+        if rule.compilable and rule.iif:
+            iif_groups.setdefault(rule.iif, set()).add(rule.group)
+    for rule in parsed:
+        if rule.index in overlapped:
+            rule.compilable = False
+        # an interface in several groups would need several marks
+        elif rule.iif and len(iif_groups[rule.iif]) > 1:
+            rule.compilable = False
+
+    # group id for each (kind, pref, table), numbered in rule order
+    marks = {}
+    limits = {'from': FROM_MARK_MASK >> 16, 'iif': IIF_MARK_MASK >> 24}
+    counters = {'from': 0, 'iif': 0}
+    for rule in parsed:
+        if not rule.compilable:
+            continue
+        kind = rule.source and 'from' or 'iif'
+        key = (kind,) + rule.group
+        if key in marks:
+            continue
+        if counters[kind] >= limits[kind]:
+            rule.compilable = False
+            continue
+        counters[kind] += 1
+        marks[key] = counters[kind]
+
+    ip_rules = []
+    emitted = set()
+    sources, iifs = [], []
+    for rule in parsed:
+        if not rule.compilable:
+            ip_rules.append(rule.rule)
+            continue
+        kind = rule.source and 'from' or 'iif'
+        key = (kind,) + rule.group
+        mask = kind == 'from' and FROM_MARK_MASK or IIF_MARK_MASK
+        if kind == 'from':
+            sources.append((rule.source, key))
+        else:
+            iifs.append((rule.iif, key))
+        if key not in emitted:
+            emitted.add(key)
+            mark = _mark(marks[key], mask)
+            ip_rules.append(f'from all fwmark {mark:#x}/{mask:#x} lookup {rule.table} pref {rule.pref}')
+
+    return CompiledRules(ip_rules, _nft_script(marks, sources, iifs), len(rules))
+
+
+def _chain_name(key):
+    kind, pref, table = key
+    return f'mark_{kind}_{pref}_{table}'
+
+
+def _nft_script(marks, sources, iifs):
+    lines = [
+        f'table inet {NFT_TABLE} {{}}\n',
+        f'delete table inet {NFT_TABLE}\n',
+    ]
+    if not marks:
+        return lines
+
+    lines.append(f'table inet {NFT_TABLE} {{\n')
+    for key, value in marks.items():
+        mask = key[0] == 'from' and FROM_MARK_MASK or IIF_MARK_MASK
+        keep = 0xffffffff & ~mask
+        lines.append(f'    chain {_chain_name(key)} {{\n')
+        lines.append(f'        meta mark set meta mark & {keep:#010x} | {_mark(value, mask):#010x}\n')
+        lines.append('    }\n')
+
+    if sources:
+        # nested or duplicated prefixes (always of the same group here) are fine for ip rules, but interval map
+        # elements must not overlap, only the outermost prefix is kept
+        elements = []
+        for network, key in sorted(sources, key=lambda s: _prefix_order(s[0])):
+            if elements and network.subnet_of(elements[-1][0]):
+                continue
+            # nft rejects the whole map for conflicting intervals, never let one through
+            if elements and network.overlaps(elements[-1][0]):
+                logger.error(f'compiled source prefix {network} overlaps {elements[-1][0]}, skipped')
+                continue
+            elements.append((network, key))
+        lines.append('    map source_marks {\n')
+        lines.append('        type ipv4_addr : verdict; flags interval;\n')
+        lines.append('        elements = {\n')
+        for network, key in elements:
+            lines.append(f'            {network} : jump {_chain_name(key)},\n')
+        lines.append('        }\n')
+        lines.append('    }\n')
+    if iifs:
+        elements = {iif: key for (iif, key) in iifs}
+        lines.append('    map iif_marks {\n')
+        lines.append('        type ifname : verdict;\n')
+        lines.append('        elements = {\n')
+        for iif, key in elements.items():
+            lines.append(f'            "{iif}" : jump {_chain_name(key)},\n')
+        lines.append('        }\n')
+        lines.append('    }\n')
+
+    # priority -150: after the chains of table inet routing (-200), so custom marks set there are kept
+    lines.append('    chain prerouting {\n')
+    lines.append('        type filter hook prerouting priority -150;\n')
+    if iifs:
+        lines.append('        iifname vmap @iif_marks\n')
+    if sources:
+        lines.append('        ip saddr vmap @source_marks\n')
+    lines.append('    }\n')
+    if sources:
+        lines.append('    chain output {\n')
+        lines.append('        type route hook output priority -150;\n')
+        lines.append('        ip saddr vmap @source_marks\n')
+        lines.append('    }\n')
+    lines.append('}\n')
+
+    logger.debug(f'compiled {len(sources)} source and {len(iifs)} iif rules into nftables maps')
+    return lines
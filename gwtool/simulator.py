@@ -0,0 +1,499 @@
+import re
+import shlex
+import random
+import ipaddress
+from pathlib import Path
+
+from gwtool.env import logger
+from gwtool.rules import FROM_MARK_MASK, IIF_MARK_MASK
+
+
+ROUTE_TYPES = ('unicast', 'throw', 'blackhole', 'unreachable', 'prohibit')
+TABLE_IDS = {'local': 255, 'main': 254, 'default': 253}
+_PREF_KEYWORDS = ('pref', 'preference', 'priority', 'order')
+
+
+def _table_id(table):
+    table = str(table)
+    return TABLE_IDS.get(table, None) or int(table, 0)
+
+
+def _network(text):
+    from gwtool.minimize import parse_prefix
+    if text == 'default':
+        return None
+    return parse_prefix(text)
+
+
+class Route:
+    __slots__ = ('network', 'type', 'nexthop')
+
+    def __init__(self, network, type='unicast', nexthop=''):
+        self.network = network
+        self.type = type
+        # everything after the prefix, e.g. "via 1.2.3.4 dev eth0" or "nexthop dev a nexthop dev b"
+        self.nexthop = nexthop
+
+    def __eq__(self, other):
+        return isinstance(other, Route) and (self.type, self.nexthop) == (other.type, other.nexthop)
+
+    def __hash__(self):
+        return hash((self.type, self.nexthop))
+
+    def __str__(self):
+        return f'{self.type} {self.network} {self.nexthop}'.strip()
+
+    __repr__ = __str__
+
+
+class Table:
+    """
+    A route table with longest prefix match, indexed by (version, prefixlen, network as integer).
+    """
+    def __init__(self):
+        self.routes = {}
+        self.prefixlens = {4: [], 6: []}
+
+    def _key(self, network):
+        return (network.version, network.prefixlen,
+                int(network.network_address) >> (network.max_prefixlen - network.prefixlen))
+
+    def replace(self, route):
+        self.routes[self._key(route.network)] = route
+        lens = self.prefixlens[route.network.version]
+        if route.network.prefixlen not in lens:
+            lens.append(route.network.prefixlen)
+            lens.sort(reverse=True)
+
+    def delete(self, network):
+        return self.routes.pop(self._key(network), None)
+
+    def lookup(self, address):
+        value = int(address)
+        bits = address.max_prefixlen
+        for prefixlen in self.prefixlens[address.version]:
+            route = self.routes.get((address.version, prefixlen, value >> (bits - prefixlen)))
+            if route is not None:
+                return route
+        return None
+
+    def __len__(self):
+        return len(self.routes)
+
+
+class Rule:
+    __slots__ = ('pref', 'source', 'destination', 'iif', 'fwmark', 'mask', 'table', 'action', 'invert',
+                 'supported', 'text')
+
+    def __init__(self, text, pref=None):
+        self.text = text
+        self.pref = pref
+        self.source = self.destination = self.iif = None
+        self.fwmark, self.mask = None, 0xffffffff
+        self.table = None
+        self.action = 'lookup'
+        self.invert = False
+        self.supported = True
+
+        tokens = shlex.split(text)
+        while tokens:
+            key = tokens.pop(0)
+            if key == 'not':
+                self.invert = True
+            elif key in ('blackhole', 'unreachable', 'prohibit'):
+                self.action = key
+            elif not tokens:
+                self.supported = False
+            elif key in _PREF_KEYWORDS:
+                self.pref = int(tokens.pop(0))
+            elif key in ('lookup', 'table'):
+                self.table = _table_id(tokens.pop(0))
+            elif key == 'from':
+                value = tokens.pop(0)
+                self.source = value != 'all' and _network(value) or None
+            elif key == 'to':
+                value = tokens.pop(0)
+                self.destination = value != 'all' and _network(value) or None
+            elif key in ('iif', 'dev'):
+                self.iif = tokens.pop(0)
+            elif key == 'fwmark':
+                mark, _, mask = tokens.pop(0).partition('/')
+                self.fwmark, self.mask = int(mark, 0), int(mask or '0xffffffff', 0)
+            else:
+                # tos, uidrange, ipproto, ... are not simulated
+                tokens.pop(0)
+                self.supported = False
+
+        if not self.supported:
+            logger.warning(f'[simulator] rule has selectors not simulated, it never matches: {text}')
+
+    def matches(self, dst, src, iif, mark):
+        if not self.supported:
+            return False
+        matched = True
+        if self.source is not None:
+            matched = src is not None and src.version == self.source.version and src in self.source
+        if matched and self.destination is not None:
+            matched = dst.version == self.destination.version and dst in self.destination
+        if matched and self.iif is not None:
+            # locally generated packets match iif lo
+            matched = (iif or 'lo') == self.iif
+        if matched and self.fwmark is not None:
+            matched = mark & self.mask == self.fwmark
+        return matched != self.invert
+
+    def __str__(self):
+        return f'{self.pref}: {self.text}'
+
+
+class NftTable:
+    """
+    The subset of an nftables table gwtool generates: mark setting chains and verdict maps used by hook chains.
+    """
+    def __init__(self):
+        self.chains = {}
+        self.maps = {}
+        self.hooks = {}
+
+
+class KernelSim:
+    """
+    In-process model of route tables, ip rules and nftables mark maps, applied with the same `ip -batch` lines and
+    nftables scripts gwtool runs on a box. lookup() answers where a packet would be routed.
+    """
+    def __init__(self):
+        self.tables = {}
+        self.rules = [Rule('from all lookup local', 0), Rule('from all lookup main', 32766),
+                      Rule('from all lookup default', 32767)]
+        self.nft = {}
+
+    # ---- apply targets ----
+
+    def apply_route_plan(self, plan):
+        """
+        Apply `ip -batch` lines, or a rendered plan file.
+        """
+        if not isinstance(plan, list):
+            with Path(plan).open(encoding='ascii') as fp:
+                plan = fp.readlines()
+        for line in plan:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                self._ip(shlex.split(line))
+
+    def apply_nft_script(self, script):
+        """
+        Apply an nftables script generated by gwtool, or a rendered script file.
+        """
+        if not isinstance(script, list):
+            with Path(script).open(encoding='ascii') as fp:
+                script = fp.readlines()
+        self._nft(script)
+
+    def table(self, table):
+        return self.tables.setdefault(_table_id(table), Table())
+
+    def _ip(self, tokens):
+        obj, command, args = tokens[0], tokens[1], tokens[2:]
+        if obj == 'route':
+            self._route(command, args)
+        elif obj == 'rule':
+            self._rule(command, args)
+        else:
+            logger.warning(f'[simulator] ip command not simulated: {" ".join(tokens)}')
+
+    def _route(self, command, args):
+        table = 'main'
+        if 'table' in args:
+            index = args.index('table')
+            table = args[index + 1]
+            args = args[:index] + args[index + 2:]
+
+        if command == 'flush':
+            self.tables.pop(_table_id(table), None)
+            return
+
+        route_type = 'unicast'
+        if args and args[0] in ROUTE_TYPES:
+            route_type = args.pop(0)
+        network = _network(args.pop(0)) or ipaddress.ip_network('0.0.0.0/0')
+        nexthop = ' '.join(args)
+
+        if command in ('add', 'replace', 'change', 'append'):
+            self.table(table).replace(Route(network, route_type, nexthop))
+        elif command in ('delete', 'del'):
+            self.table(table).delete(network)
+        else:
+            logger.warning(f'[simulator] ip route command not simulated: {command}')
+
+    def _rule(self, command, args):
+        if command == 'flush':
+            # the local rule (pref 0) is never flushed
+            self.rules = [rule for rule in self.rules if rule.pref == 0]
+            return
+        rule = Rule(' '.join(shlex.quote(arg) for arg in args))
+        if command == 'add':
+            if rule.pref is None:
+                # kernel puts rules without pref just before the first non-zero pref rule
+                prefs = [r.pref for r in self.rules if r.pref]
+                rule.pref = prefs and min(prefs) - 1 or 0
+            self.rules.append(rule)
+            # stable: rules of same pref stay in insertion order
+            self.rules.sort(key=lambda r: r.pref)
+        elif command in ('delete', 'del'):
+            for existing in self.rules:
+                if existing.text == rule.text or (rule.pref is not None and existing.pref == rule.pref):
+                    self.rules.remove(existing)
+                    break
+        else:
+            logger.warning(f'[simulator] ip rule command not simulated: {command}')
+
+    _table_re = re.compile(r'^table\s+(\w+)\s+(\w+)\s*\{\s*(\}?)$')
+    _delete_re = re.compile(r'^delete\s+table\s+(\w+)\s+(\w+)$')
+    _block_re = re.compile(r'^(chain|map|set|flowtable)\s+(\w+)\s*\{\s*(\}?)$')
+    _hook_re = re.compile(r'hook\s+(\w+)')
+    _mark_re = re.compile(r'^meta mark set meta mark & (0x[0-9a-f]+) \| (0x[0-9a-f]+)$')
+    _vmap_re = re.compile(r'^(ip saddr|iifname) vmap @(\w+)$')
+    _element_re = re.compile(r'^"?([^"\s]+)"?\s*:\s*jump\s+(\w+),?$')
+
+    def _nft(self, lines):
+        table = block = None
+        # braces opened inside a block, e.g. `elements = {`
+        nested = 0
+        for line in lines:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            match = self._delete_re.match(line)
+            if match:
+                self.nft.pop(match.group(2), None)
+                continue
+            match = self._table_re.match(line)
+            if match:
+                table = self.nft.setdefault(match.group(2), NftTable())
+                if match.group(3):
+                    table = None
+                continue
+            match = self._block_re.match(line)
+            if match and table is not None:
+                block = (match.group(1), match.group(2))
+                if block[0] == 'chain':
+                    table.chains.setdefault(block[1], [])
+                elif block[0] == 'map':
+                    table.maps.setdefault(block[1], [])
+                if match.group(3):
+                    block = None
+                continue
+            if line == '}':
+                if nested:
+                    nested -= 1
+                elif block is not None:
+                    block = None
+                else:
+                    table = None
+                continue
+            if table is None or block is None:
+                continue
+
+            kind, name = block
+            if kind == 'chain':
+                hook = self._hook_re.search(line)
+                if line.startswith('type ') and hook:
+                    table.hooks[hook.group(1)] = name
+                    continue
+                match = self._mark_re.match(line)
+                if match:
+                    table.chains[name].append(('mark', int(match.group(1), 16), int(match.group(2), 16)))
+                    continue
+                match = self._vmap_re.match(line)
+                if match:
+                    table.chains[name].append(('vmap', match.group(1), match.group(2)))
+                    continue
+            elif kind == 'map':
+                if line.endswith('{'):
+                    nested += 1
+                match = self._element_re.match(line)
+                if match:
+                    key = match.group(1)
+                    if '/' in key or re.match(r'^[0-9.]+$', key):
+                        key = ipaddress.ip_network(key)
+                    table.maps[name].append((key, match.group(2)))
+                continue
+            else:
+                continue
+            logger.debug(f'[simulator] nft statement not simulated: {line}')
+
+    # ---- queries ----
+
+    def _run_chain(self, table, name, mark, src, iif, depth=0):
+        for statement in table.chains.get(name, []):
+            if statement[0] == 'mark':
+                _, keep, value = statement
+                mark = (mark & keep) | value
+            elif statement[0] == 'vmap':
+                _, selector, map_name = statement
+                for key, target in table.maps.get(map_name, []):
+                    if selector == 'iifname':
+                        hit = iif is not None and key == iif
+                    else:
+                        hit = src is not None and src.version == 4 and src in key
+                    if hit and depth < 16:
+                        mark = self._run_chain(table, target, mark, src, iif, depth + 1)
+                        break
+        return mark
+
+    def mark(self, src, iif, mark=0):
+        """
+        Mark after nftables hook chains: prerouting for forwarded packets (iif given), output for local ones.
+        """
+        hook = iif is not None and 'prerouting' or 'output'
+        for table in self.nft.values():
+            chain = table.hooks.get(hook)
+            if chain:
+                mark = self._run_chain(table, chain, mark, src, iif)
+        return mark
+
+    def lookup(self, dst, src=None, iif=None, mark=0):
+        """
+        (table, Route) a packet is routed by, or None if no rule gives a route. Unreachable, blackhole and prohibit
+        routes and rule actions are returned as they are.
+        """
+        dst = ipaddress.ip_address(dst)
+        src = src is not None and ipaddress.ip_address(src) or None
+        mark = self.mark(src, iif, mark)
+        return self.route(dst, self.candidates(src, iif, mark), src, iif, mark)
+
+    def candidates(self, src, iif, mark):
+        """
+        Rules which may match a packet of the given context, mark is the one after nftables. Rules selecting on the
+        destination are kept for route() to decide, all others are decided here once for every destination.
+        """
+        return [rule for rule in self.rules
+                if rule.destination is not None or rule.invert or rule.matches(None, src, iif, mark)]
+
+    def route(self, dst, rules, src=None, iif=None, mark=0):
+        """
+        lookup() of a destination address with rules from candidates().
+        """
+        for rule in rules:
+            if (rule.destination is not None or rule.invert) and not rule.matches(dst, src, iif, mark):
+                continue
+            if rule.action != 'lookup':
+                return (None, Route(None, rule.action))
+            table = self.tables.get(rule.table)
+            route = table.lookup(dst) if table is not None else None
+            # no route or throw route: continue with next rule
+            if route is None or route.type == 'throw':
+                continue
+            return (rule.table, route)
+        return None
+
+    # ---- verification helpers ----
+
+    def boundaries(self):
+        """
+        First address of every prefix and the address after every prefix. Between two consecutive boundaries all
+        addresses match the same routes, so checking boundaries covers every address.
+        """
+        addresses = set()
+        for table in self.tables.values():
+            for route in table.routes.values():
+                addresses |= _edges(route.network)
+        return addresses
+
+    def contexts(self):
+        """
+        (src, iif, mark) combinations which make a difference to rules and mark maps. Sources are both boundaries
+        of every source prefix. Sources and iifs are only combined as rules selecting on both combine them, marks
+        are combined with every source and iif, as compiled mark bits and fwmark rules meet in one mark.
+        """
+        sources, iifs, marks = {None}, {None}, {0}
+        pairs = set()
+        for rule in self.rules:
+            if rule.source is not None:
+                sources |= _edges(rule.source)
+            if rule.iif is not None:
+                iifs.add(rule.iif)
+            if rule.source is not None and rule.iif is not None:
+                pairs.update((src, rule.iif) for src in _edges(rule.source))
+            # marks in the compiled rule bits are only ever set by the route_rules nftables table
+            if rule.fwmark is not None and rule.fwmark & ~(FROM_MARK_MASK | IIF_MARK_MASK):
+                marks.add(rule.fwmark & ~(FROM_MARK_MASK | IIF_MARK_MASK))
+        for table in self.nft.values():
+            for elements in table.maps.values():
+                for key, _ in elements:
+                    if isinstance(key, str):
+                        iifs.add(key)
+                    else:
+                        sources |= _edges(key)
+
+        pairs.update((src, None) for src in sources)
+        pairs.update((None, iif) for iif in iifs)
+        return {(src, iif, mark) for (src, iif) in pairs for mark in marks}
+
+
+def _edges(network):
+    """
+    First address of network and the address right after it, if any.
+    """
+    edges = {network.network_address}
+    if int(network.broadcast_address) < (1 << network.max_prefixlen) - 1:
+        edges.add(network.broadcast_address + 1)
+    return edges
+
+
+def load_plan(plan):
+    """
+    Simulator with a rendered plan applied, including the nftables script next to it if any.
+    """
+    sim = KernelSim()
+    plan = Path(plan)
+    nft = plan.with_suffix('.nft')
+    if nft.exists():
+        sim.apply_nft_script(nft)
+    sim.apply_route_plan(plan)
+    return sim
+
+
+def _key(result):
+    if result is None:
+        return None
+    table, route = result
+    return (table, route.type, route.nexthop)
+
+
+def describe(result):
+    if result is None:
+        return 'no route'
+    table, route = result
+    return table is None and route.type or f'table {table}: {route}'
+
+
+def compare(old, new, samples=0, exhaustive=True, seed=None, limit=20):
+    """
+    Compare how old and new simulators route destinations, for all route boundaries (exhaustive) and/or random
+    samples, in every context rules distinguish. Returns (checked, mismatched, examples) with up to limit examples.
+    """
+    destinations = set()
+    if exhaustive:
+        destinations |= old.boundaries() | new.boundaries()
+    rng = random.Random(seed)
+    for _ in range(samples):
+        destinations.add(ipaddress.IPv4Address(rng.getrandbits(32)))
+
+    contexts = old.contexts() | new.contexts()
+    checked = mismatched = 0
+    examples = []
+    for src, iif, mark in sorted(contexts, key=str):
+        # marks and rules matching regardless of the destination only depend on the context
+        old_mark, new_mark = old.mark(src, iif, mark), new.mark(src, iif, mark)
+        old_rules, new_rules = old.candidates(src, iif, old_mark), new.candidates(src, iif, new_mark)
+        for dst in destinations:
+            checked += 1
+            before = old.route(dst, old_rules, src, iif, old_mark)
+            after = new.route(dst, new_rules, src, iif, new_mark)
+            if _key(before) != _key(after):
+                mismatched += 1
+                if len(examples) < limit:
+                    examples.append((dst, src, iif, mark, before, after))
+    return checked, mismatched, examples
@@ -0,0 +1,195 @@
+import time
+import ipaddress
+from pathlib import Path
+
+from gwtool.env import logger
+from gwtool.libgw import Interface
+
+
+# memory of one conntrack entry with its extensions and hash nodes, a bit more than sizeof(struct nf_conn)
+CONNTRACK_ENTRY_BYTES = 384
+# share of RAM conntrack may use when full
+CONNTRACK_MEMORY_SHARE = 1 / 32
+# concurrent flows expected per Mbit/s of wan capacity
+CONNTRACK_PER_MBIT = 256
+CONNTRACK_MIN = 65536
+# entries per hash bucket when conntrack is full, the average chain length
+CONNTRACK_BUCKET_RATIO = 2
+
+NEIGH_MIN = 1024
+# memory of one neighbour entry with its hardware header cache
+NEIGH_ENTRY_BYTES = 512
+# share of RAM the neighbour tables of one family may use when full
+NEIGH_MEMORY_SHARE = 1 / 256
+# far above any real lan, a huge lan subnet (e.g. 10.0.0.0/8) is mostly empty
+NEIGH_MAX = 1 << 20
+IPV6_ROUTE_MAX_SIZE_MIN = 16384
+
+SYSCTL_FILE = Path('/etc/sysctl.d/99-gwtool-tune.conf')
+MODPROBE_FILE = Path('/etc/modprobe.d/gwtool-conntrack.conf')
+
+
+def _pow2(value):
+    """
+    Smallest power of two not less than value.
+    """
+    return 1 << max(0, int(value) - 1).bit_length()
+
+
+def _pow2_floor(value):
+    """
+    Largest power of two not greater than value.
+    """
+    return 1 << max(0, int(value).bit_length() - 1)
+
+
+def memory_bytes():
+    with open('/proc/meminfo') as fp:
+        for line in fp:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+
+
+def wan_capacity_mbit():
+    """
+    Sum of configured cake bandwidth of wan interfaces, falling back to their link speed. None if unknown.
+    """
+    total = 0
+    for interface in Interface.in_group(1):
+        if interface.config and interface.config.bandwidth:
+            total += interface.config.bandwidth / 1000000
+            continue
+        try:
+            speed = int(Path(f'/sys/class/net/{interface.ifname}/speed').read_text())
+        except (OSError, ValueError):
+            # virtual links (ppp, tunnels) have no speed
+            continue
+        if speed > 0:
+            total += speed
+    return total or None
+
+
+def lan_hosts():
+    """
+    Number of host addresses in subnets of lan interfaces, the most neighbours the gateway may have.
+    """
+    hosts = 0
+    for interface in Interface.in_group(2):
+        for address in interface.addresses:
+            network = ipaddress.ip_interface(address).network
+            if network.version == 4:
+                hosts += network.num_addresses
+            else:
+                # ipv6 subnets are huge, count them as a /22 worth of active hosts
+                hosts += 1024
+    return hosts
+
+
+def sizing():
+    """
+    Proposed sysctl values, as list of (key, value, reason).
+    """
+    memory = memory_bytes()
+    capacity = wan_capacity_mbit()
+
+    # never exceed the memory budget
+    conntrack_max = _pow2_floor(memory * CONNTRACK_MEMORY_SHARE / CONNTRACK_ENTRY_BYTES)
+    reason = f'{CONNTRACK_MEMORY_SHARE:.2%} of {memory >> 20} MiB RAM'
+    if capacity:
+        by_capacity = max(CONNTRACK_MIN, _pow2(capacity * CONNTRACK_PER_MBIT))
+        if by_capacity < conntrack_max:
+            conntrack_max = by_capacity
+            reason = f'{capacity:.0f} Mbit/s wan capacity'
+    buckets = _pow2(conntrack_max / CONNTRACK_BUCKET_RATIO)
+
+    # twice the hosts of lan subnets, within the memory budget
+    neigh = min(_pow2(lan_hosts() * 2), _pow2_floor(memory * NEIGH_MEMORY_SHARE / NEIGH_ENTRY_BYTES), NEIGH_MAX)
+    neigh = max(NEIGH_MIN, neigh)
+    neigh_reason = f'lan hosts, at most {NEIGH_MEMORY_SHARE:.2%} of RAM'
+
+    values = [
+        ('net.netfilter.nf_conntrack_max', conntrack_max, reason),
+        ('net.netfilter.nf_conntrack_buckets', buckets, f'{CONNTRACK_BUCKET_RATIO} entries per bucket when full'),
+        ('net.ipv6.route.max_size', max(IPV6_ROUTE_MAX_SIZE_MIN, conntrack_max // 8), 'ipv6 route cache entries'),
+    ]
+    for family in ('ipv4', 'ipv6'):
+        values.extend([
+            (f'net.{family}.neigh.default.gc_thresh1', neigh // 8, neigh_reason),
+            (f'net.{family}.neigh.default.gc_thresh2', neigh // 2, neigh_reason),
+            (f'net.{family}.neigh.default.gc_thresh3', neigh, neigh_reason),
+        ])
+    return values
+
+
+def apply_sizing(values):
+    from gwtool.utils import xrun
+
+    lines = ['# generated by `gw tune --apply`, overrides 99-gateway.conf\n']
+    for key, value, reason in values:
+        lines.append(f'# {reason}\n{key}={value}\n')
+    SYSCTL_FILE.write_text(''.join(lines))
+    logger.info(f'[tune] written {SYSCTL_FILE}')
+
+    # buckets sysctl only applies to a loaded module, the option sizes it when loaded at boot
+    buckets = dict((key, value) for key, value, _ in values)['net.netfilter.nf_conntrack_buckets']
+    MODPROBE_FILE.write_text(f'options nf_conntrack hashsize={buckets}\n')
+    logger.info(f'[tune] written {MODPROBE_FILE}')
+
+    xrun(f'sysctl -p {SYSCTL_FILE}')
+
+
+def _read_int(path):
+    try:
+        return int(Path(path).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def conntrack_counters():
+    """
+    Per cpu counters of /proc/net/stat/nf_conntrack summed up. Column names differ among kernels, they are read from
+    the header line.
+    """
+    with open('/proc/net/stat/nf_conntrack') as fp:
+        names = fp.readline().split()
+        totals = dict.fromkeys(names, 0)
+        for line in fp:
+            for name, value in zip(names, line.split()):
+                totals[name] += int(value, 16)
+    # entries is a global counter repeated on each cpu line
+    totals.pop('entries', None)
+    return totals
+
+
+def monitor(interval=5, count=0, echo=print):
+    """
+    Sample conntrack usage every interval seconds, count times or forever if 0. Returns the peak entry count.
+    """
+    conntrack_max = _read_int('/proc/sys/net/netfilter/nf_conntrack_max')
+    buckets = _read_int('/proc/sys/net/netfilter/nf_conntrack_buckets')
+    echo(f'conntrack max={conntrack_max} buckets={buckets}')
+
+    peak = 0
+    previous = conntrack_counters()
+    sample = 0
+    try:
+        while not count or sample < count:
+            time.sleep(interval)
+            sample += 1
+            entries = _read_int('/proc/sys/net/netfilter/nf_conntrack_count') or 0
+            peak = max(peak, entries)
+            current = conntrack_counters()
+            delta = {name: current[name] - previous.get(name, 0) for name in current}
+            previous = current
+
+            fill = conntrack_max and entries / conntrack_max or 0
+            chain = buckets and entries / buckets or 0
+            echo(f'entries={entries} fill={fill:.1%} chain={chain:.2f} '
+                 f'insert_failed={delta.get("insert_failed", 0)} drop={delta.get("drop", 0)} '
+                 f'early_drop={delta.get("early_drop", 0)} search_restart={delta.get("search_restart", 0)}')
+    except KeyboardInterrupt:
+        pass
+
+    # twice the measured peak leaves room for bursts
+    echo(f'peak entries={peak}, suggested nf_conntrack_max >= {max(CONNTRACK_MIN, _pow2(peak * 2))}')
+    return peak
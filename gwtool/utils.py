@@ -2,11 +2,16 @@ import os
 import sys
 import time
 import shlex
+import errno
+import asyncio
+import select
 import shutil
 import socket
+import struct
+import ctypes
 import ipaddress
 from pathlib import Path
-from subprocess import call
+from subprocess import call, PIPE
 
 
 DEVNULL = open(os.devnull, 'wb')
@@ -32,6 +37,16 @@ def single_instance(name=__file__):
                 raise e
 
 
+def release_single_instance():
+    """Release the lock taken by single_instance(), so other instances can run.
+    """
+    global single_instance_lock
+    if single_instance_lock is None:
+        return
+    single_instance_lock.close()
+    single_instance_lock = None
+
+
 def run_as_root():
     """Ensure this script is running with root user.
     """
@@ -102,11 +117,17 @@ def xrun(command):
 
 
 def _gen_command(prefix):
-    def _command(*args, **kwargs):
-        command = prefix if isinstance(prefix, list) else shlex.split(prefix)
+    def _build(*args):
+        command = list(prefix) if isinstance(prefix, list) else shlex.split(prefix)
         for arg in args:
             command.extend(shlex.split(arg))
-        xcall(command, **kwargs)
+        return command
+
+    def _command(*args, **kwargs):
+        xcall(_build(*args), **kwargs)
+
+    # build the command without running it, e.g. for xcall_graph()
+    _command.command = _build
     return _command
 
 
@@ -117,6 +138,210 @@ ipxfrm = _gen_command('ip xfrm')
 nft = _gen_command('nft')
 
 
+class Command:
+    """
+    A command in the graph run by xcall_graph(). It starts after all commands named in `after` succeeded, and all
+    commands named in `wait` finished, whatever their result.
+    """
+    def __init__(self, name, command, after=(), input=None, silence_error=False, wait=()):
+        self.name = name
+        self.command = shlex.split(command) if isinstance(command, str) else command
+        self.after = list(after)
+        self.wait = list(wait)
+        # bytes or str fed to stdin
+        self.input = input.encode() if isinstance(input, str) else input
+        self.silence_error = silence_error
+
+
+class CommandResult:
+    __slots__ = ('name', 'command', 'returncode', 'stdout', 'stderr', 'skipped')
+
+    def __init__(self, name, command, returncode=None, stdout=b'', stderr=b'', skipped=False):
+        self.name = name
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        # not run, because a dependency failed or fail_fast aborted the graph
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __str__(self):
+        status = self.skipped and 'skipped' or f'returncode={self.returncode}'
+        return f'<CommandResult name={self.name} {status}>'
+
+    __repr__ = __str__
+
+
+class CommandResults:
+    """
+    Results of xcall_graph(), by command name in the order commands were given.
+    """
+    def __init__(self, results):
+        self.results = results
+
+    @property
+    def ok(self):
+        return all(result.ok for result in self.results.values())
+
+    @property
+    def failed(self):
+        return [r for r in self.results.values() if not r.skipped and not r.ok]
+
+    @property
+    def skipped(self):
+        return [r for r in self.results.values() if r.skipped]
+
+    def __getitem__(self, name):
+        return self.results[name]
+
+    def __iter__(self):
+        return iter(self.results.values())
+
+
+async def _xcall_graph(commands, limit, fail_fast):
+    from gwtool.env import logger
+
+    semaphore = asyncio.Semaphore(limit)
+    tasks = {}
+    results = {}
+    aborted = False
+
+    async def run(cmd):
+        nonlocal aborted
+        for name in cmd.after + cmd.wait:
+            await tasks[name]
+        if aborted or not all(results[name].ok for name in cmd.after):
+            results[cmd.name] = CommandResult(cmd.name, cmd.command, skipped=True)
+            return
+
+        async with semaphore:
+            if aborted:
+                results[cmd.name] = CommandResult(cmd.name, cmd.command, skipped=True)
+                return
+            logger.info(f'Call command: {" ".join(cmd.command)}')
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd.command,
+                    stdin=cmd.input is not None and PIPE or DEVNULL, stdout=PIPE, stderr=PIPE)
+                stdout, stderr = await proc.communicate(cmd.input)
+                result = CommandResult(cmd.name, cmd.command, proc.returncode, stdout, stderr)
+            except OSError as e:
+                # e.g. command not found, reported like a failed command
+                result = CommandResult(cmd.name, cmd.command, 127, b'', str(e).encode())
+
+        results[cmd.name] = result
+        if not result.ok:
+            if not cmd.silence_error:
+                logger.error(f'ERROR: command exited with non-zero: {result.returncode}, name={cmd.name}, '
+                             f'stderr={result.stderr.decode(errors="replace").strip()}')
+            if fail_fast:
+                aborted = True
+
+    for cmd in commands:
+        if cmd.name in tasks:
+            raise ValueError(f'Duplicated command name: {cmd.name}')
+        for name in cmd.after + cmd.wait:
+            # dependencies must be declared first, this also rules out cycles
+            if name not in tasks:
+                raise ValueError(f'Unknown dependency of {cmd.name}: {name}')
+        tasks[cmd.name] = asyncio.ensure_future(run(cmd))
+
+    await asyncio.gather(*tasks.values())
+    return CommandResults({cmd.name: results[cmd.name] for cmd in commands})
+
+
+def xcall_graph(commands, limit=4, fail_fast=False):
+    """
+    Run a graph of Command concurrently, at most `limit` processes at a time. Commands whose dependencies failed
+    are skipped. With fail_fast, no new command is started after a failure. Returns CommandResults.
+    """
+    return asyncio.run(_xcall_graph(commands, limit, fail_fast))
+
+
+class Inotify:
+    """
+    Minimal inotify(7) binding via libc, we only need to watch a few directories for changed files.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+
+    # a file got new content: written in place, or renamed into / out of the directory by an editor
+    FILE_CHANGES = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+    _event = struct.Struct('iIII')
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f'inotify_init1(): {os.strerror(e)}')
+        self._watches = {}
+
+    def add_watch(self, path, mask=FILE_CHANGES | IN_ONLYDIR):
+        path = Path(path)
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f'inotify_add_watch({path}): {os.strerror(e)}')
+        self._watches[wd] = path
+        return wd
+
+    def read(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) and return list of changed paths.
+        """
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except InterruptedError:
+            return []
+        if not readable:
+            return []
+
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+
+        paths = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = self._event.unpack_from(buf, offset)
+            offset += self._event.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            paths.append(directory / os.fsdecode(name) if name else directory)
+        return paths
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def is_valid_cidr(address):
     try:
         ipaddress.ip_network(address, strict=False)
@@ -0,0 +1,201 @@
+import errno
+from pyroute2 import IPRoute, WireGuard
+from pyroute2.netlink.exceptions import NetlinkError
+
+from gwtool.env import env, logger
+from gwtool import libgw
+
+
+class PeerState:
+    """
+    Comparable state of a peer, built either from config or from the live device.
+    """
+    __slots__ = ('public_key', 'preshared_key', 'endpoint', 'persistent_keepalive', 'allowed_ips')
+
+    def __init__(self, public_key, preshared_key=None, endpoint=None, persistent_keepalive=None, allowed_ips=()):
+        self.public_key = public_key
+        self.preshared_key = preshared_key
+        self.endpoint = endpoint
+        self.persistent_keepalive = persistent_keepalive or 0
+        self.allowed_ips = set(allowed_ips)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.public_key, config.preshared_key, config.endpoint, config.persistent_keepalive,
+                   config.allowed_ips)
+
+
+def _decode_key(value):
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    # kernel reports an all-zero key if no preshared key is set
+    if not value or value == 'A' * 43 + '=':
+        return None
+    return value
+
+
+def live_state(wg, ifname):
+    """
+    Private key, listen port and {public_key: PeerState} of the live device.
+    """
+    private_key, listen_port = None, None
+    peers = {}
+    # large devices are dumped in several messages, a peer's allowed ips may be continued in the next one
+    for msg in wg.info(ifname):
+        private_key = _decode_key(msg.get_attr('WGDEVICE_A_PRIVATE_KEY')) or private_key
+        listen_port = msg.get_attr('WGDEVICE_A_LISTEN_PORT') or listen_port
+        for peer in msg.get_attr('WGDEVICE_A_PEERS') or []:
+            public_key = _decode_key(peer.get_attr('WGPEER_A_PUBLIC_KEY'))
+            state = peers.get(public_key)
+            if state is None:
+                endpoint = peer.get_attr('WGPEER_A_ENDPOINT')
+                state = peers[public_key] = PeerState(
+                    public_key,
+                    preshared_key=_decode_key(peer.get_attr('WGPEER_A_PRESHARED_KEY')),
+                    endpoint=endpoint and (endpoint['addr'], endpoint['port']),
+                    persistent_keepalive=peer.get_attr('WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL'),
+                )
+            for allowed_ip in peer.get_attr('WGPEER_A_ALLOWEDIPS') or []:
+                state.allowed_ips.add(allowed_ip['addr'])
+    return private_key, listen_port, peers
+
+
+def diff_peers(live, desired):
+    """
+    Peer specs for WireGuard.set() which turn live peers into desired ones, unchanged peers are left alone.
+    """
+    specs = []
+
+    for public_key in sorted(set(live) - set(desired)):
+        specs.append({'public_key': public_key, 'remove': True})
+
+    for public_key, want in sorted(desired.items()):
+        have = live.get(public_key)
+        spec = {'public_key': public_key}
+
+        if have is None:
+            spec['allowed_ips'] = sorted(want.allowed_ips)
+            spec['replace_allowed_ips'] = True
+        elif want.allowed_ips != have.allowed_ips:
+            if have.allowed_ips - want.allowed_ips:
+                spec['allowed_ips'] = sorted(want.allowed_ips)
+                spec['replace_allowed_ips'] = True
+            else:
+                # only additions, allowed ips are appended without the replace flag
+                spec['allowed_ips'] = sorted(want.allowed_ips - have.allowed_ips)
+
+        # endpoint is only enforced if configured, otherwise the peer may roam
+        if want.endpoint and (have is None or want.endpoint != have.endpoint):
+            spec['endpoint_addr'], spec['endpoint_port'] = want.endpoint
+        if have is None or want.persistent_keepalive != have.persistent_keepalive:
+            spec['persistent_keepalive'] = want.persistent_keepalive
+        if want.preshared_key and (have is None or want.preshared_key != have.preshared_key):
+            spec['preshared_key'] = want.preshared_key
+
+        if len(spec) > 1:
+            specs.append(spec)
+
+    return specs
+
+
+def ensure_device(ifname):
+    """
+    Create the wireguard link if it does not exist, it joins the tunnel devgroup unless configured otherwise.
+    """
+    with IPRoute() as ipr:
+        if ipr.link_lookup(ifname=ifname):
+            return False
+        config = env.gwconfig.interfaces.get(ifname)
+        devgroup = config and config.devgroup or 4
+        logger.info(f'[wireguard] creating link {ifname}, group={devgroup}')
+        ipr.link('add', ifname=ifname, kind='wireguard')
+        index = ipr.link_lookup(ifname=ifname)[0]
+        ipr.link('set', index=index, group=devgroup, state='up')
+    # the link may have been loaded as missing, routes of this run must see it
+    libgw.Interface.refresh(ifname)
+    return True
+
+
+def sync_device(config):
+    """
+    Apply the difference between config and the live device over netlink. Returns (removed, current) allowed ips.
+    """
+    ensure_device(config.name)
+    desired = {peer.public_key: PeerState.from_config(peer) for peer in config.peers.values()}
+
+    with WireGuard() as wg:
+        private_key, listen_port, live = live_state(wg, config.name)
+
+        device = {}
+        want_key = config.get_private_key()
+        if want_key and want_key != private_key:
+            device['private_key'] = want_key
+        if config.listen_port and config.listen_port != listen_port:
+            device['listen_port'] = config.listen_port
+        if config.fwmark is not None:
+            device['fwmark'] = config.fwmark
+        if device:
+            wg.set(config.name, **device)
+
+        specs = diff_peers(live, desired)
+        for spec in specs:
+            wg.set(config.name, peer=spec)
+
+    logger.info(f'[wireguard] {config.name}: {len(desired)} peers, {len(specs)} changed')
+
+    live_ips = set().union(*[peer.allowed_ips for peer in live.values()])
+    desired_ips = set().union(*[peer.allowed_ips for peer in desired.values()])
+    return live_ips - desired_ips, desired_ips
+
+
+def route_lines(config, table, allowed_ips, command='replace'):
+    return [f'route {command} table {table} {cidr} dev {config.name}\n' for cidr in sorted(allowed_ips)]
+
+
+def table_routes(table):
+    """
+    {prefix: gwdef} of all wireguard peers in the given table, for building a complete table.
+    """
+    routes = {}
+    for config in env.gwconfig.wireguard.values():
+        if table not in config.tables:
+            continue
+        interface = libgw.Interface.get(config.name)
+        if not interface or not interface.exists:
+            logger.error(f'wireguard interface does not exist: {config.name}, routes skipped')
+            continue
+        for peer in config.peers.values():
+            for cidr in peer.allowed_ips:
+                routes[cidr] = f'dev {config.name}'
+    return routes
+
+
+def table_route_lines(table):
+    return [f'route replace table {table} {prefix} {gwdef}\n' for prefix, gwdef in sorted(table_routes(table).items())]
+
+
+def sync_plan(rebuilt_tables=()):
+    """
+    Sync all configured wireguard devices, returns route commands for their allowed ips in `ip -batch` format.
+    Tables in rebuilt_tables are left out, the caller builds them as a whole.
+    """
+    lines = []
+    for config in env.gwconfig.wireguard.values():
+        try:
+            removed, current = sync_device(config)
+        except NetlinkError as e:
+            if e.code == errno.EOPNOTSUPP:
+                logger.error(f'[wireguard] kernel does not support wireguard, {config.name} skipped')
+            else:
+                logger.error(f'[wireguard] netlink error syncing {config.name}, skipped: {e}')
+            continue
+        except (OSError, ValueError) as e:
+            # e.g. private_key_file not created yet, a failed device must not stop firewall and route setup
+            logger.error(f'[wireguard] failed to sync {config.name}, skipped: {e}')
+            continue
+        for table in config.tables:
+            if table in rebuilt_tables:
+                continue
+            lines.extend(route_lines(config, table, removed, command='delete'))
+            lines.extend(route_lines(config, table, current))
+    return lines